@@ -36,6 +36,8 @@ class Env:
         self.cache: tp.Optional[Path] = None  # cache for precomputation
         # models used to create features (Eg: word embeddings)
         self.feature_models: tp.Optional[Path] = None
+        # address of a model host serving the heavy feature models (see bm.features.host)
+        self.model_host: tp.Optional[str] = None
 
         # Hijacking this part of the code as it is one of the first
         # to be executed, so a great place to set the start method.
@@ -85,6 +87,8 @@ class Env:
             if val is not None:
                 if name in ('cache', 'feature_models'):
                     kwargs[name] = Path(val)
+                elif name == 'model_host':
+                    kwargs[name] = str(val)
                 elif name == "study_paths" and val is not None:
                     study_paths = self._get_host_study_paths(val)
                     kwargs["studies"].update(
@@ -107,7 +111,7 @@ class Env:
         """
         currents: tp.Dict[str, tp.Any] = {}
         for key, val in kwargs.items():
-            if isinstance(val, str):
+            if isinstance(val, str) and key != 'model_host':
                 val = Path(val)
             currents[key] = getattr(self, key)
             setattr(self, key, val)
@@ -5,9 +5,12 @@
 # LICENSE file in the root directory of this source tree.
 
 """Caching utility."""
+import contextlib
+import fcntl
 import hashlib
 import json
 import logging
+import pickle
 from pathlib import Path
 import typing as tp
 
@@ -16,6 +19,7 @@ from omegaconf.basecontainer import BaseContainer
 from omegaconf import OmegaConf
 import torch
 
+from . import profiling
 from ._env import env
 from .utils import write_and_rename
 
@@ -55,6 +59,7 @@ class Cache:
         that will change across runs and is harder to debug.
         """
         self._suffix = {"torch": ".pkl", "memmap": ".npy"}[mode]
+        self.name = name
         if env.cache is None:
             self.path = None
         else:
@@ -68,26 +73,58 @@ class Cache:
         name = _get_signature(key)
         return self.path / (name + self._suffix)
 
+    def _load(self, path: Path) -> tp.Any:
+        if self._suffix == ".pkl":
+            return torch.load(path)
+        else:
+            # read-only, so that modifying the loaded values cannot alter the cache
+            return np.lib.format.open_memmap(path, mode="r")
+
+    def _save(self, path: Path, result: tp.Any) -> None:
+        with write_and_rename(path, pid=True) as tmp:
+            if self._suffix == ".pkl":
+                torch.save(result, tmp)
+            else:
+                assert isinstance(result, np.ndarray), "Only np.ndarrays are allowed"
+                np.save(tmp, result)
+
     def get(self, _computation, **kwargs) -> tp.Any:
         path = self.cache_path(kwargs)
         if path is not None and path.exists():
             try:
-                if self._suffix == ".pkl":
-                    return torch.load(path)
-                else:
-                    return np.lib.format.open_memmap(path)
+                with profiling.timer("Cache:" + self.name, "hit"):
+                    return self._load(path)
             except OSError as error:
                 logger.warning("Error while loading cache file: %r", error)
-        result = _computation(**kwargs)
-        if path is not None:
-            with write_and_rename(path, pid=True) as tmp:
-                if self._suffix == ".pkl":
-                    torch.save(result, tmp)
-                else:
-                    assert isinstance(result, np.ndarray), "Only np.ndarrays are allowed"
-                    np.save(tmp, result)
+        with profiling.timer("Cache:" + self.name, "miss"):
+            result = _computation(**kwargs)
+            if path is not None:
+                self._save(path, result)
         return result
 
+    def precompute(self, _bulk_computation, kwargs_list: tp.Sequence[tp.Dict[str, tp.Any]],
+                   batch_size: int = 32) -> None:
+        """Fills the cache for all the provided keys at once, so that subsequent calls to `get`
+        with the same kwargs are cache hits. `_bulk_computation` is called with lists of
+        at most `batch_size` kwargs missing from the cache, and must return the list of
+        corresponding results. This is a no-op if no cache path is available.
+        """
+        if self.path is None:
+            return
+        missing: tp.List[tp.Tuple[Path, tp.Dict[str, tp.Any]]] = []
+        for kwargs in kwargs_list:
+            path = self.cache_path(kwargs)
+            assert path is not None
+            if not path.exists():
+                missing.append((path, kwargs))
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start: start + batch_size]
+            with profiling.timer("Cache:" + self.name, "precompute"):
+                results = _bulk_computation([kwargs for _, kwargs in batch])
+            assert len(results) == len(batch)
+            for (path, _), result in zip(batch, results):
+                self._save(path, result)
+
 
 class MemoryCache:
     """Same as Cache but in memory, used for sharing a model between multiple
@@ -115,3 +152,153 @@ class MemoryCache:
             value = _computation(*args, **kwargs)
             self._cache_dict[key] = value
             return value
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path) -> tp.Iterator[None]:
+    """Exclusive lock shared by all the processes using the given lock file."""
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class StimulusRegistry:
+    """Table of the values of a feature for each stimulus (e.g. each word in its sentence),
+    shared by all the recordings which saw this stimulus. Each stimulus is identified
+    by a hashable and picklable key and mapped to a row of `table`, of shape
+    [n_stimuli, dimension].
+
+    If a cache path is available, the table is stored as a raw float32 file opened as a
+    read-only memmap, so that the values are loaded once and shared by all the recordings
+    and processes. There is one registry per process for each name and args.
+    The files are only ever appended to, under a file lock, so that the row of a stimulus
+    never changes once written, even with several processes filling the registry
+    (e.g. the workers of `get_datasets`).
+    """
+    _REGISTRIES: tp.Dict[tp.Tuple[str, str, str], "StimulusRegistry"] = {}
+
+    def __init__(self, name: str, args: tp.Any = None):
+        self.name = name
+        self.index: tp.Dict[tp.Any, int] = {}
+        self.table: tp.Optional[np.ndarray] = None
+        if env.cache is None:
+            self.path = None
+        else:
+            folder = env.cache / "StimulusRegistry" / name
+            folder.mkdir(exist_ok=True, parents=True)
+            self.path = folder / _get_signature(args)
+            self._load()
+
+    @classmethod
+    def get(cls, name: str, args: tp.Any = None) -> "StimulusRegistry":
+        key = (name, _get_signature(args), str(env.cache))
+        if key not in cls._REGISTRIES:
+            cls._REGISTRIES[key] = cls(name, args)
+        return cls._REGISTRIES[key]
+
+    def __getstate__(self) -> tp.Dict[str, tp.Any]:
+        # the memmap is reopened rather than pickled with its whole content
+        state = dict(self.__dict__)
+        if self.path is not None:
+            state["table"] = None
+        return state
+
+    def __setstate__(self, state: tp.Dict[str, tp.Any]) -> None:
+        self.__dict__.update(state)
+        if self.path is not None and self.index:
+            index, self.index = self.index, {}
+            self._load()
+            if all(self.index.get(key) == row for key, row in index.items()):
+                return  # rows never move, the table may only have grown
+            # the files were removed and filled again, so the rows must be re-mapped
+            lost = [key for key in index if key not in self.index]
+            if lost:
+                raise RuntimeError(f"Stimulus registry {self.path} lost {len(lost)} stimuli.")
+            assert self.table is not None
+            keys = sorted(index, key=index.__getitem__)
+            self.table = np.asarray(self.table[[self.index[key] for key in keys]])
+            self.index = index
+            self.path = None  # now in memory, with the rows known when pickled
+
+    def _paths(self) -> tp.Tuple[Path, Path]:
+        assert self.path is not None
+        return self.path.with_suffix(".keys.pkl"), self.path.with_suffix(".f32")
+
+    def _read_keys(self) -> tp.Tuple[tp.List[tp.Any], int, int]:
+        """Returns the keys stored on disk, the dimension and the size of the complete
+        records of the keys file. Each record is a (dimension, keys) tuple, appended after
+        the corresponding rows of the table, so all the keys read have their rows.
+        """
+        keys_path, _ = self._paths()
+        keys: tp.List[tp.Any] = []
+        dimension, size = 0, 0
+        if not keys_path.exists():
+            return keys, dimension, size
+        with open(keys_path, "rb") as f:
+            while True:
+                try:
+                    dimension, batch = pickle.load(f)
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError) as error:
+                    # partial record (interrupted or concurrent write)
+                    logger.warning("Error while loading stimulus registry: %r", error)
+                    break
+                keys.extend(batch)
+                size = f.tell()
+        return keys, dimension, size
+
+    def _load(self) -> None:
+        keys, dimension, _ = self._read_keys()
+        if not keys:
+            return
+        _, table_path = self._paths()
+        self.table = np.memmap(table_path, dtype=np.float32, mode="r",
+                               shape=(len(keys), dimension))
+        self.index = {key: row for row, key in enumerate(keys)}
+
+    def _append(self, keys: tp.List[tp.Any], values: np.ndarray) -> None:
+        """Appends the keys which are still missing once the registry is locked."""
+        keys_path, table_path = self._paths()
+        assert self.path is not None
+        with _file_lock(self.path.with_suffix(".lock")):
+            stored, dimension, size = self._read_keys()
+            assert not stored or dimension == values.shape[1]
+            known = set(stored)
+            new = [k for k, key in enumerate(keys) if key not in known]
+            if new:
+                # discard what an interrupted write may have left after the last record
+                num_bytes = len(stored) * values.shape[1] * values.itemsize
+                with open(table_path, "ab") as f:
+                    f.truncate(num_bytes)
+                    f.write(np.ascontiguousarray(values[new]).tobytes())
+                with open(keys_path, "ab") as f:
+                    f.truncate(size)
+                    pickle.dump((values.shape[1], [keys[k] for k in new]), f)
+        self._load()
+
+    def rows(self, keys: tp.Sequence[tp.Any],
+             _computation: tp.Callable[[tp.List[tp.Any]], np.ndarray]) -> np.ndarray:
+        """Returns the row of `table` matching each of the keys. `_computation` is called
+        once with the list of the keys not yet in the registry, and must return their values
+        as an array of shape [len(missing), dimension].
+        """
+        missing = list(dict.fromkeys(key for key in keys if key not in self.index))
+        if missing and self.path is not None:
+            self._load()  # they may have been added by other processes
+            missing = [key for key in missing if key not in self.index]
+        if missing:
+            with profiling.timer("StimulusRegistry:" + self.name, "miss"):
+                values = np.asarray(_computation(missing), dtype=np.float32)
+            assert values.ndim == 2 and len(values) == len(missing)
+            if self.path is None:
+                self.table = values if self.table is None else np.concatenate([self.table, values])
+                self.index.update({key: len(self.index) + k for k, key in enumerate(missing)})
+            else:
+                self._append(missing, values)
+        else:
+            profiling.record("StimulusRegistry:" + self.name, "hit")
+        return np.array([self.index[key] for key in keys], dtype=np.int64)
@@ -20,7 +20,7 @@ from dora.log import LogProgress
 from torch.nn import functional as F
 from torch.utils.data import ConcatDataset
 
-from . import env, studies
+from . import env, profiling, studies
 from .cache import Cache
 from .events import Event, assign_blocks, split_wav_as_block
 from .features import FeaturesBuilder
@@ -361,6 +361,13 @@ class SegmentDataset:
         self.meg_dimension = meg_dimension
         if meg_dimension is not None:
             assert meg_dimension >= self.recording.meg_dimension
+        self._direct_read = _can_read_directly(epochs)
+        self._memmap: tp.Optional[np.ndarray] = None  # opened lazily in each process
+
+    def __getstate__(self) -> tp.Dict[str, tp.Any]:
+        state = dict(self.__dict__)
+        state["_memmap"] = None
+        return state
 
     def _get_bounds_times(self, idx: int) -> tp.Tuple[float, float]:
         """Infers the start and stop times of a given epoch"""
@@ -382,12 +389,34 @@ class SegmentDataset:
         start, stop = self._get_bounds_times(idx)
         return self.features(start, stop)
 
+    def _get_meg(self, idx: int) -> np.ndarray:
+        """Get the MEG of epoch idx, identical to `next(self.epochs[idx])`.
+        For recordings stored as memmaps, the window is sliced directly from the array
+        instead of going through the mne reading machinery.
+        """
+        if not self._direct_read:
+            return next(self.epochs[idx])
+        ep = self.epochs
+        if self._memmap is None:
+            self._memmap = ep._raw.memmap
+        start = ep.events[idx, 0] + self.sample_rate.to_ind(ep._raw_times[0]) - ep._raw.first_samp
+        stop = start + len(ep._raw_times)
+        meg = np.array(self._memmap[ep.picks, start: stop], dtype=np.float64)
+        if ep.baseline is not None:
+            # same as mne.baseline.rescale
+            bmin, bmax = ep.baseline
+            times = ep._raw_times
+            imin = 0 if bmin is None else int(np.where(times >= bmin)[0][0])
+            imax = len(times) if bmax is None else int(np.where(times <= bmax)[0][-1]) + 1
+            meg -= meg[:, imin: imax].mean(axis=-1, keepdims=True)
+        return meg
+
     def __len__(self) -> int:
         return len(self.epochs)
 
     def __getitem__(self, index: tp.Any) -> tp.Any:
         if isinstance(index, int):
-            meg = next(self.epochs[index])
+            meg = self._get_meg(index)
             meg_torch = torch.from_numpy(meg).float()
             if self.meg_dimension is not None:
                 meg_torch = F.pad(
@@ -417,6 +446,25 @@ class SegmentDataset:
         return (self[k] for k in range(len(self)))  # pleases mypy
 
 
+def _can_read_directly(epochs: mne.Epochs) -> bool:
+    """Whether the epochs are plain windows of a memmap recording, with at most a
+    baseline correction, so that `SegmentDataset` can slice them without mne.
+    """
+    data_types = {"mag", "grad", "ref_meg", "eeg"}
+    return (
+        isinstance(epochs._raw, studies.RawMemmap) and
+        not epochs.preload and
+        epochs.detrend is None and
+        getattr(epochs, "_decim", 1) == 1 and
+        getattr(epochs, "_offset", None) is None and
+        not epochs.info["projs"] and
+        epochs.reject is None and
+        epochs.flat is None and
+        not len(epochs._raw.annotations) and
+        set(epochs.get_channel_types()) <= data_types  # baseline applies to all channels
+    )
+
+
 Datasets = namedtuple("Datasets", "train valid test")
 
 
@@ -630,4 +678,5 @@ def get_datasets(
     )
     logger.info(msg)
 
+    profiling.log_report("get_datasets")
     return Datasets(*splits)
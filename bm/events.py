@@ -17,12 +17,11 @@ event kind.
 import hashlib
 import random
 import typing as tp
-from dataclasses import asdict, dataclass, fields
+from dataclasses import MISSING, asdict, dataclass, fields
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import torchaudio
 from dora import to_absolute_path
 
 from . import utils
@@ -54,6 +53,24 @@ class Event:
             **{k: v for k, v in row.items() if k in [f.name for f in fields(cls)]}
         )
 
+    @classmethod
+    def _validate_frame(cls, frame: pd.DataFrame) -> pd.DataFrame:
+        """Vectorized version of the checks and updates of the instantiation, for a DataFrame of
+        events of this kind (see `EventAccessor.validate`). The DataFrame is updated in-place.
+        """
+        missing = [
+            f.name for f in fields(cls)
+            if f.name not in frame.columns and f.default is MISSING and f.default_factory is MISSING
+        ]
+        if missing:
+            raise TypeError(f"{cls.__name__} events are missing required fields {missing}.")
+        for f in fields(cls):
+            if f.name not in frame.columns:
+                frame[f.name] = f.default
+        if (frame.duration < 0).any():
+            raise ValueError("Negative durations are not allowed for events.")
+        return frame
+
     @classmethod
     def _kind(cls) -> str:
         """Convenience method to get the name from the class."""
@@ -133,6 +150,7 @@ class Sound(Event):
             actual_duration = self.duration
         else:
             assert Path(self.filepath).exists(), f"{self.filepath} does not exist."
+            import torchaudio  # lazy import, only needed for sound events
             info = torchaudio.info(self.filepath)
             actual_duration = float(info.num_frames / info.sample_rate) - self.offset
             if self.duration is None or self.duration == 0:
@@ -140,6 +158,15 @@ class Sound(Event):
             else:
                 self.duration = min(actual_duration, self.duration)
 
+    @classmethod
+    def _validate_frame(cls, frame: pd.DataFrame) -> pd.DataFrame:
+        frame = super()._validate_frame(frame)
+        # durations are read from the files, one event at a time
+        sounds = [cls.from_dict(row) for row in frame.to_dict("records")]
+        for name in ["filepath", "offset", "duration"]:
+            frame[name] = [getattr(sound, name) for sound in sounds]
+        return frame
+
 
 @dataclass
 class Word(Event):
@@ -160,6 +187,13 @@ class Word(Event):
         assert self.modality in ["audio", "visual"]
         self.word_index = int(self.word_index)
 
+    @classmethod
+    def _validate_frame(cls, frame: pd.DataFrame) -> pd.DataFrame:
+        frame = super()._validate_frame(frame)
+        assert frame.modality.isin(["audio", "visual"]).all()
+        frame["word_index"] = frame.word_index.astype(int)
+        return frame
+
 
 @dataclass
 class Phoneme(Event):
@@ -197,6 +231,12 @@ class Block(Event):
         super().__post_init__()
         self.uid = str(self.uid)
 
+    @classmethod
+    def _validate_frame(cls, frame: pd.DataFrame) -> pd.DataFrame:
+        frame = super()._validate_frame(frame)
+        frame["uid"] = frame.uid.astype(str)
+        return frame
+
 
 # Functions for processing events into blocks
 
@@ -228,8 +268,11 @@ def extract_sequence_info(
     Updated DataFrame of events.
     """
 
-    def is_missing(df, key):
-        return key not in df.columns or all(df[key].isnull())
+    def is_missing(df, key, keys):
+        """For each row, whether the key is missing for the whole group of the row"""
+        if key not in df.columns:
+            return pd.Series(True, index=df.index)
+        return df[key].isnull().groupby(keys).transform("all")
 
     events_out = events.copy()
 
@@ -248,58 +291,88 @@ def extract_sequence_info(
         if words.sequence_id.nunique() < 2:
             raise ValueError("Only one word sequence ID found.")
 
-        for _, d in words.groupby("sequence_id"):
-            # define word indices by making it compatible for multiple words
-            if is_missing(d, "word_index"):  # Index of the word in the sequence
-                indices = np.cumsum([0] + [len(w.split()) for w in d.word])
-                events_out.loc[d.index, "word_index"] = indices[:-1]
-
-            if is_missing(d, "word_sequence"):  # Sequence of words
-                for uid in d.index:
-                    events_out.loc[uid, "word_sequence"] = " ".join(d.word.values)
+        words = words[words.sequence_id.notnull()]
+        sequence_ids = words.sequence_id
+        # define word indices by making it compatible for multiple words
+        missing = is_missing(words, "word_index", sequence_ids)
+        if missing.any():  # Index of the word in the sequence
+            num_words = words.word.str.split().str.len()
+            indices = num_words.groupby(sequence_ids).cumsum() - num_words
+            if "word_index" not in events_out.columns:
+                events_out["word_index"] = np.nan
+            events_out.loc[missing[missing].index, "word_index"] = indices[missing]
+
+        missing = is_missing(words, "word_sequence", sequence_ids)
+        if missing.any():  # Sequence of words
+            sequences = words.word.groupby(sequence_ids).transform(" ".join)
+            events_out.loc[missing[missing].index, "word_sequence"] = sequences[missing]
 
     if phoneme and (events.kind == "phoneme").any():
         phonemes = events_out[events_out.kind == "phoneme"]
-        if is_missing(phonemes, "word_index"):
+        if "word_index" not in phonemes.columns or all(phonemes.word_index.isnull()):
             raise ValueError('Column "word_index" is required but was not found.')
 
-        for _, group in phonemes.groupby(["sequence_id", "word_index"]):
-            if is_missing(group, "phoneme_id"):
-                events_out.loc[group.index, "phoneme_id"] = range(len(group))
+        phonemes = phonemes[phonemes.sequence_id.notnull() & phonemes.word_index.notnull()]
+        keys = [phonemes.sequence_id, phonemes.word_index]
+        missing = is_missing(phonemes, "phoneme_id", keys)
+        if missing.any():
+            phoneme_ids = phonemes.groupby(keys).cumcount()
+            events_out.loc[missing[missing].index, "phoneme_id"] = phoneme_ids[missing]
 
     return events_out
 
 
-def _get_block_uid(events: pd.DataFrame) -> str:
-    """Get block unique IDs for the events contained in a DataFrame.
+def _get_block_uids(events: pd.DataFrame, block_index: np.ndarray, num_blocks: int) -> tp.List[str]:
+    """Get the unique IDs of blocks from the events they contain.
 
     The unique ID of a block is either the concatenation of the words or filepaths it contains, or,
     if available and unique, the value in the 'sequence_uid' column.
-    """
-    if (
-        "sequence_uid" in events.columns
-    ):  # Use existing sequence_uid, e.g. with Schoffelen2019
-        unique_sequence_uids = events.sequence_uid.unique()
-        if len(unique_sequence_uids) == 1:
-            uid = unique_sequence_uids[0]
-            return uid
-
-    # Use concatenation of words or filepaths
-    has_words = events.condition.isin(EventAccessor.WORD_CONDITIONS) & (
-        events.kind != "phoneme"
-    )
-    if not any(has_words):  # Use filepaths if there are no words in the block
-        uid_ = [f for f in events.filepath.unique() if isinstance(f, str)]
-        assert len(
-            uid_
-        ), "No filepath information available for defining block unique ID."
-        uid_ += [str(events.start.min())]
-    else:
-        uid_ = events.loc[has_words].word.astype(str)
 
-    uid = " ".join(uid_)
+    Parameters
+    ----------
+    events :
+        DataFrame of events.
+    block_index :
+        Index of the block containing each event, or -1 if the event is not contained in a block.
+    num_blocks :
+        Number of blocks.
+    """
+    # group the events by block with a stable sort, so that each block keeps the event order
+    order = np.argsort(block_index, kind="stable")
+    bounds = np.searchsorted(block_index[order], np.arange(num_blocks + 1))
+    sequence_uids = events.sequence_uid.to_numpy() if "sequence_uid" in events.columns else None
+    has_words: tp.Optional[np.ndarray] = None  # only computed if needed
+    words = events.word.astype(str).to_numpy() if "word" in events.columns else None
+    filepaths = events.filepath.to_numpy() if "filepath" in events.columns else None
+    starts = events.start.to_numpy()
+
+    uids: tp.List[tp.Any] = []
+    for block in range(num_blocks):
+        indices = order[bounds[block]: bounds[block + 1]]
+        if sequence_uids is not None:  # Use existing sequence_uid, e.g. with Schoffelen2019
+            unique_sequence_uids = pd.unique(sequence_uids[indices])
+            if len(unique_sequence_uids) == 1:
+                uids.append(unique_sequence_uids[0])
+                continue
+        # Use concatenation of words or filepaths
+        if has_words is None:
+            has_words = (
+                events.condition.isin(EventAccessor.WORD_CONDITIONS) & (events.kind != "phoneme")
+            ).to_numpy()
+        word_indices = indices[has_words[indices]]
+        if not len(word_indices):  # Use filepaths if there are no words in the block
+            assert filepaths is not None
+            uid_ = [f for f in pd.unique(filepaths[indices]) if isinstance(f, str)]
+            assert len(
+                uid_
+            ), "No filepath information available for defining block unique ID."
+            uid_ += [str(starts[indices].min())]
+        else:
+            assert words is not None
+            uid_ = list(words[word_indices])
+        uids.append(" ".join(uid_))
 
-    return uid
+    return uids
 
 
 def _create_blocks(events: pd.DataFrame, groupby: str) -> pd.DataFrame:
@@ -326,45 +399,42 @@ def _create_blocks(events: pd.DataFrame, groupby: str) -> pd.DataFrame:
     ), f"by={groupby} not supported, must be one of {EventAccessor.VALID_BLOCK_TYPES}."
 
     # Find events that are valid block starts
-    blocks = list()
-    for event in events.event.iter():
-        if groupby == "sentence":
-            block_start = (event.kind == "word") and (event.word_index == 0)
-        elif groupby == "sound":
-            block_start = event.kind == "sound"
-        elif groupby == "fixation":
-            block_start = event.condition == "fixation"
-        elif groupby == "sentence_or_sound":  # Used for Schoffelen2019
-            block_start = (event.kind == "sound") or (
-                (event.kind == "word")
-                and (event.modality == "visual")
-                and (event.word_index == 0)
-            )
-        else:
-            block_start = False
-
-        if block_start:
-            blocks.append(event)
+    is_word_start = (events.kind == "word") & (events.get("word_index") == 0)
+    if groupby == "sentence":
+        is_block_start = is_word_start
+    elif groupby == "sound":
+        is_block_start = events.kind == "sound"
+    elif groupby == "sentence_or_sound":  # Used for Schoffelen2019
+        is_block_start = (events.kind == "sound") | (is_word_start & (events.modality == "visual"))
+    starts = events.start[is_block_start].to_numpy()
 
     eps = 1e-7
     event_stops = events.start + events.duration
     events_end = event_stops.max() + eps
-    assert all(np.diff([b.start for b in blocks]) > 0), "events not sorted"
-    block_stops = [b.start for b in blocks[1:]] + [events_end]
+    assert all(np.diff(starts) > 0), "events not sorted"
+    block_stops = np.append(starts[1:], events_end)
+
+    # Assign each event to the block it starts in, if it stops before the end of the block
+    block_index = np.searchsorted(starts, events.start.to_numpy(), side="right") - 1
+    contained = block_index >= 0
+    contained[contained] &= event_stops.to_numpy()[contained] < block_stops[block_index[contained]]
+    block_index[~contained] = -1
+    # Create block unique IDs based on all events contained in each block
+    uids = _get_block_uids(events, block_index, len(starts))
 
     # Add boundary unique ID
     block_events = list()
-    for block, stop in zip(blocks, block_stops):
-        # Create block unique ID based on all events contained in the block
-        mask = (events.start >= block.start) & ((events.start + events.duration) < stop)
-        uid = _get_block_uid(events[mask])
+    starting_events = events[is_block_start]
+    for start, stop, uid, language, modality in zip(
+            starts.tolist(), block_stops.tolist(), uids, starting_events.language.tolist(),
+            starting_events.modality.tolist()):
         block_info = asdict(  # Convert to Block object to apply checks
             Block(
-                start=block.start,
-                duration=stop - block.start,
+                start=start,
+                duration=stop - start,
                 uid=uid,
-                language=block.language,
-                modality=block.modality,
+                language=language,
+                modality=modality,
             )
         )
         block_events.append(block_info)
@@ -532,39 +602,54 @@ def split_wav_as_block(
 
     sound_mask = events.kind == "sound"
     other_events = events[~sound_mask]
-    events_queue = [
-        event for _, event in events[sound_mask].iterrows()
-    ]  # Benchmarked - iterrows
-    # is fine here
+    sounds = events[sound_mask]
+    starts, durations, offsets = (
+        sounds[name].to_numpy(dtype=float) for name in ["start", "duration", "offset"]
+    )
 
-    new_events = list()
+    # Sweep over the blocks and the sounds, the current sound being either a fragment left
+    # from the previous block or the next sound
+    fragments: tp.List[tp.Tuple[int, float, float, float]] = []  # sound, start, duration, offset
+    remainder: tp.Optional[tp.Tuple[int, float, float, float]] = None
+    next_sound = 0
     for start, stop in blocks:
-        while events_queue:
-            if events_queue[0].start >= stop - margin:
+        while remainder is not None or next_sound < len(sounds):
+            if remainder is None:
+                k = next_sound
+                current = (k, starts[k], durations[k], offsets[k])
+            else:
+                current = remainder
+            sound, sound_start, duration, offset = current
+            if sound_start >= stop - margin:
                 # we go to the next block.
                 break
-            event = events_queue.pop(0)
-            if event.start + event.duration <= start + margin:
+            if remainder is None:
+                next_sound += 1
+            remainder = None
+            split: tp.Optional[float] = None
+            if sound_start + duration <= start + margin:
                 # almost no overlap with current block
                 pass
-            elif event.start <= start - margin:
+            elif sound_start <= start - margin:
                 # a significant portion of the audio is before the block
-                new_event = event.copy(deep=True)
-                event.duration = start - event.start
-                new_event.offset += event.duration
-                new_event.start += event.duration
-                new_event.duration -= event.duration
-                events_queue.insert(0, new_event)
-            elif event.start + event.duration > stop + margin:
-                new_event = event.copy(deep=True)
-                event.duration = stop - event.start
-                new_event.start += event.duration
-                new_event.offset += event.duration
-                new_event.duration -= event.duration
-                # we push new event for further processing as it might overlap many blocks.
-                events_queue.insert(0, new_event)
-            new_events.append(event)
-    events = pd.concat([pd.DataFrame(new_events + events_queue), other_events])
+                split = start - sound_start
+            elif sound_start + duration > stop + margin:
+                # the rest is processed next, as it might overlap many blocks.
+                split = stop - sound_start
+            if split is not None:
+                remainder = (sound, sound_start + split, duration - split, offset + split)
+                current = (sound, sound_start, split, offset)
+            fragments.append(current)
+    if remainder is not None:
+        fragments.append(remainder)
+    fragments.extend((k, starts[k], durations[k], offsets[k])
+                     for k in range(next_sound, len(sounds)))
+
+    sources, *columns = zip(*fragments) if fragments else ([], [], [], [])
+    new_sounds = sounds.iloc[list(sources)].copy()
+    for name, values in zip(["start", "duration", "offset"], columns):
+        new_sounds[name] = np.array(values, dtype=float)
+    events = pd.concat([new_sounds, other_events])
     events = events.sort_values("start", ignore_index=True)
 
     return events
@@ -581,7 +666,7 @@ class EventAccessor:
     For more information about events and the `EventAccessor`, see `doc/recordings_and_events.md`.
     """
 
-    CLASS_KIND_MAPPING = {
+    CLASS_KIND_MAPPING: tp.Dict[str, tp.Type[Event]] = {
         "word": Word,
         "multiple_words": MultipleWords,
         "sound": Sound,
@@ -593,9 +678,15 @@ class EventAccessor:
     WORD_CONDITIONS = {"sentence", "context", "question", "fixation", "word_list"}
     VALID_BLOCK_TYPES = {"sentence", "sound", "sentence_or_sound"}
 
+    # key of `DataFrame.attrs` marking the frames returned by `validate`
+    VALIDATED_ATTR = "events_validated"
+
     def __init__(self, frame: pd.DataFrame) -> None:
         self._frame = frame
-        self._frame = self.validate()
+        self._validated = False
+        if not frame.attrs.get(self.VALIDATED_ATTR, False):
+            self._frame = self.validate()
+            self._validated = True
 
     @classmethod
     def list_required_fields(cls, kind: tp.Optional[str] = None) -> None:
@@ -618,43 +709,37 @@ class EventAccessor:
             for kind in cls.CLASS_KIND_MAPPING.keys():
                 cls.list_required_fields(kind)
 
-    def _validate_event(self, event: pd.Series) -> dict:
-        """Validate event, i.e. check fields and values are as expected, and update it accordingly.
-
-        This is done by instantiating an event object of the corresponding kind, which carries out
-        the validation, and then updating the input with the applied changes (if any).
-        """
-        # Check kinds are valid
-        if event["kind"] not in self.CLASS_KIND_MAPPING.keys():
-            raise ValueError(
-                f'Unexpected kind "{event["kind"]}". Support for new event kinds can be added by'
-                " creating new `Event` classes in `bm.events`."
-            )
-
-        # Build event object to run the checks inside the kind-specific Event class
-        event_class: tp.Type[Event] = self.CLASS_KIND_MAPPING[event.kind]
-        event_obj = event_class.from_dict(event)
-
-        # Add back fields that were ignored by the Event class
-        # event.update(asdict(event_obj))  # Very slow, use dict updating instead
-        event = {**event, **asdict(event_obj)}
-
-        return event
-
     def validate(self) -> pd.DataFrame:
         """Validate the DataFrame of events.
 
+        The events of each kind are checked and updated at once by the corresponding Event class
+        (see `Event._validate_frame`), as would be done by instantiating an event for each row.
+        The output is marked as validated, so that accessing `.event` on it, or on frames derived
+        from it by pandas (copies, selections...), does not validate it again: `validate` must be
+        called explicitly after modifying validated events.
+
         Returns
         -------
         pd.DataFrame
             DataFrame in which each row has been validated and updated accordingly.
         """
-        if not self._frame.empty:
-            return pd.DataFrame(
-                self._frame.apply(self._validate_event, axis=1).tolist()
-            )
+        if self._validated or self._frame.empty:
+            out = self._frame.copy()
         else:
-            return self._frame.copy()
+            frame = self._frame.reset_index(drop=True)
+            unknown = ~frame.kind.isin(self.CLASS_KIND_MAPPING.keys())
+            if unknown.any():
+                raise ValueError(
+                    f'Unexpected kind "{frame.kind[unknown].iloc[0]}". Support for new event '
+                    "kinds can be added by creating new `Event` classes in `bm.events`."
+                )
+            groups = [
+                self.CLASS_KIND_MAPPING[kind]._validate_frame(frame.loc[index].copy())
+                for kind, index in frame.groupby("kind", sort=False).groups.items()
+            ]
+            out = pd.concat(groups).loc[frame.index].infer_objects()
+        out.attrs[self.VALIDATED_ATTR] = True
+        return out
 
     def iter(self) -> tp.Iterator[Event]:
         """Iterate over rows of the DataFrame to yield Event objects."""
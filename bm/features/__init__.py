@@ -8,6 +8,5 @@ words or wav file names, into actual dense features for training neural network,
 or to be used as targets for the contrastive loss.
 """
 from .base import FeaturesBuilder, Feature  # noqa
-from . import basic  # noqa
-from . import audio  # noqa
-from . import embeddings  # noqa
+# the modules defining the features (basic, audio, embeddings) are imported
+# on demand by `FeaturesBuilder.get_feature_class`.
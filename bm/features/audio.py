@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 """All the supported audio features."""
 
+from collections import OrderedDict
 import logging
 import math
 import os
@@ -19,28 +20,35 @@ import torchaudio
 import numpy as np
 from bm import events
 from bm.cache import Cache, MemoryCache
-from bm.lib.pitch_calc.yin import compute_yin
 from bm.utils import CaptureInit, Frequency
 from torch.nn import functional as F
 
-from . import base
+from . import base, host
 
 logger = logging.getLogger(__name__)
 
 
 class MelSpectrum(base.Feature, CaptureInit):
     """Outputs the sound waves with the features frequency
+
+    With `on_device=True`, the builder only outputs the (normalized) waveform, folded as
+    `raw_dimension` consecutive samples per time step, and the mel spectrogram
+    is computed by batch on the training device with `compute_on_device`.
+    The waveform is then resampled to `raw_dimension * sample_rate`, the closest
+    multiple of the sample rate above `in_sampling`.
     """
     event_kind = "sound"
 
     def __init__(self, sample_rate: Frequency, n_mels=40, n_fft=512, in_sampling=16_000,
                  normalized=True, use_log_scale=True, log_scale_eps=1e-5,
-                 norm_audio: bool = True) -> None:
+                 norm_audio: bool = True, on_device: bool = False) -> None:
         super().__init__(sample_rate)
         self.dimension = n_mels
         kwargs = self._init_kwargs
         kwargs.pop('sample_rate')
         self.cache = Cache(self.__class__.__name__, kwargs)
+        self.resampled_cache = _resampled_cache(self.__class__.__name__, kwargs, sample_rate)
+        self.on_device = on_device
 
         self.in_sampling = in_sampling
         self.n_mels = n_mels
@@ -55,9 +63,23 @@ class MelSpectrum(base.Feature, CaptureInit):
             n_fft=n_fft, hop_length=self.hop_length, normalized=normalized
         )
 
-        if use_log_scale:
+        if on_device:
+            assert float(sample_rate).is_integer(), "on_device requires an integer sample rate"
+            self._samples_per_step = math.ceil(in_sampling / sample_rate)
+            self.wav_sampling = self._samples_per_step * int(sample_rate)
+            self.waveform_cache = _resampled_cache(
+                self.__class__.__name__ + "Waveform", kwargs, sample_rate)
+            self.device_trans = torchaudio.transforms.MelSpectrogram(
+                sample_rate=self.wav_sampling, n_mels=self.n_mels,
+                n_fft=n_fft, hop_length=self.hop_length, normalized=normalized
+            )
+        elif use_log_scale:  # the default value of the waveform is silence
             self.default_value = math.log10(log_scale_eps)
 
+    @property
+    def raw_dimension(self) -> int:
+        return self._samples_per_step if self.on_device else self.dimension
+
     def _compute(self, filepath: Path, start: float, stop: float) -> torch.Tensor:
         wav, sr = _extract_wav_part(filepath, start, stop)
         wav = torch.mean(wav, dim=0)  # stereo to mono
@@ -75,12 +97,47 @@ class MelSpectrum(base.Feature, CaptureInit):
             melspec = torch.log10(melspec + self.log_scale_eps)
         return melspec
 
-    def get(self, event: events.Sound) -> torch.Tensor:
-        melspec = self.cache.get(
-            self._compute, filepath=event.filepath,
+    def _resample(self, filepath: Path, start: float, stop: float,
+                  num_samples: int) -> np.ndarray:
+        melspec = self.cache.get(self._compute, filepath=filepath, start=start, stop=stop)
+        return F.interpolate(melspec[None], num_samples)[0].numpy()
+
+    def _compute_waveform(self, filepath: Path, start: float, stop: float) -> np.ndarray:
+        wav, sr = _extract_wav_part(filepath, start, stop)
+        wav = torch.mean(wav, dim=0)  # stereo to mono
+        if self.norm_audio:
+            wav = (wav - wav.mean()) / (1e-8 + wav.std())
+        wav = julius.resample.ResampleFrac(old_sr=int(sr), new_sr=self.wav_sampling)(wav)
+        return wav.numpy()
+
+    def _get_waveform_on_overlap(
+            self, event: events.Sound, overlap: events.DataSlice) -> torch.Tensor:
+        wav = self.waveform_cache.get(
+            self._compute_waveform, filepath=event.filepath,
             start=event.offset, stop=event.offset + event.duration)
-        feature_samples = self.sample_rate.to_ind(event.stop - event.start)
-        return F.interpolate(melspec[None], feature_samples)[0]
+        step = self._samples_per_step
+        first = max(0, -overlap._sample_rate.to_ind(event.start - overlap.start))
+        chunk = torch.from_numpy(np.array(wav[first * step: (first + overlap.duration_ind) * step]))
+        chunk = F.pad(chunk, (0, overlap.duration_ind * step - len(chunk)))
+        return chunk.view(overlap.duration_ind, step).t()  # [T * step] -> [step, T]
+
+    def compute_on_device(self, data: torch.Tensor) -> torch.Tensor:
+        wav = data.transpose(1, 2).reshape(len(data), -1)  # [B, step, T] -> [B, T * step]
+        trans = self.device_trans.to(data.device)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            melspec = trans(wav)
+        if self.use_log_scale:
+            melspec = torch.log10(melspec + self.log_scale_eps)
+        return F.interpolate(melspec, data.shape[-1])
+
+    def get(self, event: events.Sound) -> torch.Tensor:
+        return torch.from_numpy(np.array(_get_resampled(self, event)))
+
+    def get_on_overlap(self, event: events.Sound, overlap: events.DataSlice) -> torch.Tensor:
+        if self.on_device:
+            return self._get_waveform_on_overlap(event, overlap)
+        return self._truncate_to_overlap(_get_resampled(self, event), event, overlap)
 
 
 class Pitch(base.Feature, CaptureInit):
@@ -95,6 +152,7 @@ class Pitch(base.Feature, CaptureInit):
         kwargs = self._init_kwargs
         kwargs.pop('sample_rate')
         self.cache = Cache(self.__class__.__name__, kwargs)
+        self.resampled_cache = _resampled_cache(self.__class__.__name__, kwargs, sample_rate)
 
         self.frame_length_in_samples = frame_length_in_samples
         self.frame_space_in_samples = frame_space_in_samples
@@ -112,7 +170,9 @@ class Pitch(base.Feature, CaptureInit):
         wav = torch.mean(wav_stereo, axis=0)  # Stereo to mono
         wav = julius.resample.ResampleFrac(old_sr=int(sr), new_sr=self.in_sampling)(wav)
 
-        pitches, harmonic_rates, argmins, times = compute_yin(
+        # lazy import, the yin module compiles numba functions
+        from bm.lib.pitch_calc.yin import compute_yin_batched
+        pitches, harmonic_rates, argmins, times = compute_yin_batched(
             sig=wav.numpy(),
             sr=self.in_sampling,
             w_len=self.frame_length_in_samples,
@@ -120,16 +180,20 @@ class Pitch(base.Feature, CaptureInit):
             harmo_thresh=self.harmonic_thresh,
             f0_min=self.min_f0,
             f0_max=self.max_f0)
-        out = torch.FloatTensor(pitches)
+        out = torch.from_numpy(pitches).float()
         return out
 
+    def _resample(self, filepath: Path, start: float, stop: float,
+                  num_samples: int) -> np.ndarray:
+        pitches = self.cache.get(self._compute, filepath=filepath, start=start, stop=stop)
+        out = F.interpolate(pitches[None, None], num_samples)[0, 0]
+        return out[None].numpy()
+
     def get(self, event: events.Sound) -> torch.Tensor:
-        pitches = self.cache.get(
-            self._compute, filepath=event.filepath,
-            start=event.offset, stop=event.offset + event.duration)
-        feature_samples = self.sample_rate.to_ind(event.stop - event.start)
-        out = F.interpolate(pitches[None, None], feature_samples)[0, 0]
-        return out[None]
+        return torch.from_numpy(np.array(_get_resampled(self, event)))
+
+    def get_on_overlap(self, event: events.Sound, overlap: events.DataSlice) -> torch.Tensor:
+        return self._truncate_to_overlap(_get_resampled(self, event), event, overlap)
 
 
 class _BaseWav2Vec(base.Feature, CaptureInit):
@@ -139,6 +203,8 @@ class _BaseWav2Vec(base.Feature, CaptureInit):
 
     event_kind = "sound"
     model_name = "facebook/wav2vec2-large-xlsr-53"
+    # number of sound events whose embedding memmap stays open in `_get_frames`
+    _MAX_FRAMES = 32
 
     def __init__(self, sample_rate: Frequency,
                  normalized: bool = True, random: bool = False,
@@ -156,6 +222,8 @@ class _BaseWav2Vec(base.Feature, CaptureInit):
         os.environ["TRANSFORMERS_VERBOSITY"] = "critical"
         self._model_cache = MemoryCache("Wav2VecEmbedding", "model")
         self._extractor_cache = MemoryCache("Wav2VecEmbedding", "extractor")
+        # cached embedding and frame timestamps of the last sound events, see `_get_frames`
+        self._frames: "OrderedDict[tp.Any, tp.Tuple[np.ndarray, np.ndarray]]" = OrderedDict()
 
     @property
     def model(self) -> tp.Any:
@@ -208,30 +276,59 @@ class _BaseWav2Vec(base.Feature, CaptureInit):
             out = out[layers].mean(0)
         return out.detach().cpu().clone().numpy()
 
+    def _get_frames(
+            self, event: events.Sound, name: str, layers: tp.Optional[tp.List[int]] = None,
+    ) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """Returns the cached embedding of the whole sound event, of shape [..., T, D]
+        (a memmap), along with the timestamps of the T + 1 frame boundaries relative
+        to the start of the event. Only the last `_MAX_FRAMES` events are kept, as each
+        memmap holds an open file.
+        """
+        key = (event.filepath, event.offset, event.duration, name,
+               None if layers is None else tuple(layers))
+        if key in self._frames:
+            self._frames.move_to_end(key)
+        else:
+            outputs = self.cache.get(
+                host.hosted(self, "_compute_hidden_states"),
+                start=event.offset, stop=event.offset + event.duration,
+                filepath=event.filepath, name=name, layers=layers)
+            embd_sr = outputs.shape[-2] / event.duration
+            # safety, to make sure we extract the right dim
+            if event.duration >= 0.5:
+                assert 42 < embd_sr < 52, (f"Unexpected sampling rate for embedding {embd_sr}",
+                                           event.duration, outputs.shape[-2])
+            # if the above assert fails, event duration may be inconsistent with actual wav
+            # duration or the wav2vec output sampling rate has changed.
+            # we'd need to either find a way to get the embedding sampling rate independently,
+            # or figure out the duration in another way
+            timestamps = np.arange(outputs.shape[-2] + 1) / embd_sr
+            self._frames[key] = (outputs, timestamps)
+            if len(self._frames) > self._MAX_FRAMES:
+                self._frames.popitem(last=False)
+        return self._frames[key]
+
     def _get_cached_tensor(
             self, event: events.Sound, overlap: events.DataSlice, name: str,
             layers: tp.Optional[tp.List[int]] = None,
     ) -> torch.Tensor:
-        outputs = self.cache.get(
-            self._compute_hidden_states, start=event.offset, stop=event.offset + event.duration,
-            filepath=event.filepath, name=name, layers=layers)
-        embd_sr = outputs.shape[-2] / event.duration
-        # safety, to make sure we extract the right dim... but maybe slow
-        if event.duration >= 0.5:
-            assert 42 < embd_sr < 52, (f"Unexpected sampling rate for embedding {embd_sr}",
-                                       event.duration, outputs.shape[-2])
-        # if the above assert fails, event duration may be inconsistent with actual wav duration
-        # or the wav2vec output sampling rate has changed.
-        # we'd need to either find a way to get the embedding sampling rate independently, or
-        # figure out the duration in another way
-        sr = Frequency(embd_sr)
-        start, stop = [sr.to_ind(x - event.start) for x in (overlap.start, overlap.stop)]
-        start = min(start, outputs.shape[-2] - 1)
-        stop = max(start + 1, stop)
-        chunk = outputs[..., start: stop, :]
-        # load into memory (probably unnecessary, but lets avoid weird issues)
-        chunk = np.array(chunk, copy=True)
-        return torch.from_numpy(chunk)
+        outputs, timestamps = self._get_frames(event, name, layers)
+        num_frames = outputs.shape[-2]
+        start, stop = (int(ind) for ind in _nearest_boundaries(
+            timestamps, np.array([overlap.start, overlap.stop]) - event.start))
+        start = min(start, num_frames - 1)
+        stop = min(max(start + 1, stop), num_frames)
+        if stop - start == overlap.duration_ind:
+            # same rate, the chunk is copied out of the read-only memmap
+            return torch.from_numpy(np.array(outputs[..., start: stop, :]))
+        # nearest neighbour resampling of the chunk to the overlap, read directly from
+        # the memmap (this also loads it into memory)
+        indices = start + _nearest_indices(stop - start, overlap.duration_ind)
+        return torch.from_numpy(np.take(outputs, indices, axis=-2))
+
+    def __getstate__(self) -> tp.Dict[str, tp.Any]:
+        # memmaps are reopened rather than pickled with their whole content
+        return dict(self.__dict__, _frames=OrderedDict())
 
     def get(self, event: events.Sound) -> torch.Tensor:
         raise RuntimeError(f"Only get_on_overlap is available for {self.__class__.__name__}")
@@ -256,8 +353,7 @@ class Wav2VecTransformer(_BaseWav2Vec):
         outputs = self._get_cached_tensor(
             event, overlap=overlap,
             name="hidden_states", layers=list(self.layers))
-        outputs = outputs[0].transpose(0, 1)  # [1, T, D] -> [T, D] -> [D, T]
-        return F.interpolate(outputs[None], overlap.duration_ind)[0]
+        return outputs[0].transpose(0, 1)  # [1, T, D] -> [T, D] -> [D, T]
 
 
 class Wav2VecConvolution(_BaseWav2Vec):
@@ -268,10 +364,7 @@ class Wav2VecConvolution(_BaseWav2Vec):
 
     def get_on_overlap(self, event: events.Sound, overlap: events.DataSlice) -> torch.Tensor:
         outputs = self._get_cached_tensor(event, overlap=overlap, name="extract_features")
-        # [1, T, D] -> [T, D] -> [D, T]
-        outputs = outputs[0].transpose(0, 1)  # [1, T, D] -> [T, D] -> [D, T]
-        out = F.interpolate(outputs[None], overlap.duration_ind)[0]
-        return out
+        return outputs[0].transpose(0, 1)  # [1, T, D] -> [T, D] -> [D, T]
 
 
 class Wav2VecChunk(_BaseWav2Vec):
@@ -321,3 +414,39 @@ def _extract_wav_part(
     delta = abs(wav.shape[-1] / sr - offset + onset)
     assert delta <= 0.1, (delta, filepath, onset, offset, onset - offset)
     return wav, sr
+
+
+def _nearest_indices(input_size: int, output_size: int) -> np.ndarray:
+    """Indices of the input samples selected by `F.interpolate(..., mode="nearest")`
+    (reproducing its float32 computation), so that resampling becomes a simple indexing.
+    """
+    if output_size in (input_size, 2 * input_size):
+        return np.arange(output_size) * input_size // output_size
+    scale = np.float32(input_size) / np.float32(output_size)
+    indices = np.floor(np.arange(output_size, dtype=np.float32) * scale).astype(np.int64)
+    return np.minimum(indices, input_size - 1)
+
+
+def _nearest_boundaries(boundaries: np.ndarray, times: np.ndarray) -> np.ndarray:
+    """Indices of the (sorted) boundaries nearest to each of the given times.
+    """
+    inds = np.clip(np.searchsorted(boundaries, times), 1, len(boundaries) - 1)
+    lower = times - boundaries[inds - 1] <= boundaries[inds] - times
+    return inds - lower
+
+
+def _resampled_cache(name: str, kwargs: tp.Dict[str, tp.Any], sample_rate: Frequency) -> Cache:
+    """Cache of the features resampled to the sample rate, stored as memmaps
+    so that reading a window does not load the whole file.
+    """
+    return Cache(name + "Resampled", dict(kwargs, sample_rate=float(sample_rate)), mode="memmap")
+
+
+def _get_resampled(feature: tp.Any, event: events.Sound) -> np.ndarray:
+    """Feature of the whole sound event at the feature sample rate, resampled once
+    and cached (requires a `_resample` method and a `resampled_cache` attribute).
+    """
+    return feature.resampled_cache.get(
+        feature._resample, filepath=event.filepath,
+        start=event.offset, stop=event.offset + event.duration,
+        num_samples=feature.sample_rate.to_ind(event.stop - event.start))
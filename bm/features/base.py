@@ -6,6 +6,7 @@
 """Basic audio features."""
 
 from collections import OrderedDict
+import importlib
 import typing as tp
 import logging
 
@@ -14,6 +15,8 @@ import pandas as pd
 import torch
 import torch.nn.functional as F
 
+from bm import profiling
+from bm.cache import StimulusRegistry
 from bm.utils import Frequency
 from bm.events import Event, DataSlice
 
@@ -23,31 +26,41 @@ logger = logging.getLogger(__name__)
 class FeaturesBuilder(OrderedDict):  # type: ignore
     """Creates array of features on-the-fly.
     """
-    # stores all features classes
+    # stores all features classes, registered when their module is imported
     _FEATURE_CLASSES: tp.Dict[str, tp.Type["Feature"]] = {}
+    # module of each feature within bm.features, imported only when the feature is requested,
+    # so that importing bm does not import their dependencies (spacy, torchaudio, numba...)
+    _FEATURE_MODULES: tp.Dict[str, str] = {
+        **dict.fromkeys(["WordPulse", "PhonemePulse", "WordSegment", "Modality", "WordLength",
+                         "WordIndex", "WordFrequency", "Phoneme", "WordHash"], "basic"),
+        **dict.fromkeys(["MelSpectrum", "Pitch", "Wav2VecTransformer", "Wav2VecConvolution",
+                         "Wav2VecChunk"], "audio"),
+        **dict.fromkeys(["WordEmbedding", "WordEmbeddingSmall", "PartOfSpeech", "BertEmbedding",
+                         "XlmEmbedding"], "embeddings"),
+    }
 
     def __init__(self, events: pd.DataFrame, features: tp.Sequence[str],
                  features_params: dict,
                  sample_rate: Frequency, event_mask: bool = False) -> None:
         super().__init__()
+        self._clear_tables()
         features = list(features)
         self.features_params = features_params
         self.sample_rate = sample_rate
         self.event_mask = event_mask
 
-        try:
-            self.update([
-                (feature,
-                 self._FEATURE_CLASSES[feature](  # type: ignore
-                     sample_rate=self.sample_rate,
-                     **features_params.get(feature, {})))
-                for feature in features])
-        except KeyError as e:
-            available = set(self._FEATURE_CLASSES)
+        available = set(self.feature_names())
+        if not available.issuperset(features):
             missing = ", ".join(set(features) - available)
             options = ", ".join(set(available) - set(features))
             raise KeyError(f"Cound not find feature(s): {missing}. "
-                           f"Did you mean one of: {options}?") from e
+                           f"Did you mean one of: {options}?")
+        self.update([
+            (feature,
+             self.get_feature_class(feature)(  # type: ignore
+                 sample_rate=self.sample_rate,
+                 **features_params.get(feature, {})))
+            for feature in features])
         # prepare events
         event_kinds = {f.event_kind for f in self.values()}
         if self.event_mask:
@@ -63,6 +76,110 @@ class FeaturesBuilder(OrderedDict):  # type: ignore
         if missing_events and len(events) > 0:
             logger.warning("Could not find any event for feature(s) "
                            "with kind(s): %s", missing_events)
+        # features computed once per stimulus, stored as the row of each event in the
+        # registry of the feature (-1 for events of other kinds), aligned with self.events
+        self._stimulus_rows: tp.Dict[str, np.ndarray] = {}
+        self._registries: tp.Dict[str, StimulusRegistry] = {}
+        # precompute scalar features once per event, stored as arrays aligned with self.events
+        self._precomputed: tp.Dict[str, np.ndarray] = {}
+        for feature in self.values():
+            rows = self._register_stimuli(feature)
+            if rows is not None:
+                self._stimulus_rows[feature.name] = rows
+                continue
+            values = self._precompute(feature)
+            if values is not None:
+                self._precomputed[feature.name] = values
+        self._precomputed_mask: tp.Optional[np.ndarray] = None
+        if self.event_mask:
+            self._precomputed_mask = self._precompute(self.word_seg_feature)
+            assert self._precomputed_mask is not None
+
+    def _precompute(self, feature: "Feature") -> tp.Optional[np.ndarray]:
+        mask = (self.events.kind == feature.event_kind).values
+        with profiling.timer(feature.name, "prepare"):
+            feature.prepare(self.events.loc[mask])
+        with profiling.timer(feature.name, "get_values"):
+            values = feature.get_values(self.events.loc[mask]) if mask.any() else None
+        if values is None:
+            return None
+        assert feature.raw_dimension == 1, "Only scalar features can provide get_values"
+        assert len(values) == mask.sum()
+        column = np.zeros(len(self.events), dtype=values.dtype)
+        column[mask] = values
+        return column
+
+    @classmethod
+    def feature_names(cls) -> tp.List[str]:
+        """Returns the names of all the available features, without importing them.
+        """
+        return sorted(set(cls._FEATURE_MODULES) | set(cls._FEATURE_CLASSES))
+
+    @classmethod
+    def get_feature_class(cls, name: str) -> tp.Type["Feature"]:
+        """Returns the class of the given feature, importing its module if needed.
+        """
+        if name not in cls._FEATURE_CLASSES and name in cls._FEATURE_MODULES:
+            importlib.import_module(f"{__package__}.{cls._FEATURE_MODULES[name]}")
+        return cls._FEATURE_CLASSES[name]
+
+    def _register_stimuli(self, feature: "Feature") -> tp.Optional[np.ndarray]:
+        mask = (self.events.kind == feature.event_kind).values
+        if not mask.any():
+            return None
+        events = self.events.loc[mask]
+        keys = feature.get_stimulus_keys(events)
+        if keys is None:
+            return None
+        assert len(keys) == len(events)
+        registry = StimulusRegistry.get(feature.name, feature.stimulus_args)
+
+        def _compute(missing: tp.List[tp.Any]) -> np.ndarray:
+            firsts: tp.Dict[tp.Any, int] = {}
+            for position, key in enumerate(keys):
+                firsts.setdefault(key, position)
+            values = np.zeros((len(missing), feature.raw_dimension), dtype=np.float32)
+            missing_events = events.iloc[[firsts[key] for key in missing]]
+            # called once the registry is reloaded, so only the stimuli which no
+            # recording or process has computed yet are prepared
+            with profiling.timer(feature.name, "prepare"):
+                feature.prepare(missing_events)
+            for k, event in enumerate(missing_events.event.iter()):
+                value = feature.get(event)
+                values[k] = value.numpy() if isinstance(value, torch.Tensor) else value
+            return values
+
+        column = np.full(len(self.events), -1, dtype=np.int64)
+        column[mask] = registry.rows(keys, _compute)
+        self._registries[feature.name] = registry
+        return column
+
+    @staticmethod
+    def _overlap_ranges(events: pd.DataFrame,
+                        dslice: DataSlice) -> tp.Tuple[np.ndarray, np.ndarray]:
+        """Vectorized version of `dslice.overlap(event).slice_in_parent()` for all events,
+        returned as the first index in the slice and the number of samples of each overlap.
+        """
+        start = np.maximum(events.start.values, dslice.start)
+        duration = np.minimum(events._stop.values, dslice.stop) - start
+        start_ind = dslice._sample_rate.to_ind(start)
+        duration_ind = dslice._sample_rate.to_ind(start + duration) - start_ind
+        return start_ind - dslice.start_ind, duration_ind
+
+    @staticmethod
+    def _get_owners(selected: np.ndarray, first: np.ndarray, duration_ind: np.ndarray,
+                    n_times: int) -> np.ndarray:
+        """Returns the index of the selected event rendered at each time step of the slice,
+        or -1 if there is none. As in the event loop, later events overwrite earlier ones.
+        """
+        owners = np.full(n_times, -1)
+        indices = np.nonzero(selected & (duration_ind >= 1))[0]
+        starts = np.minimum(first[indices], n_times)
+        lengths = np.minimum(first[indices] + duration_ind[indices], n_times) - starts
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.repeat(starts, lengths) + offsets
+        np.maximum.at(owners, positions, np.repeat(indices, lengths))
+        return owners
 
     # pylint: disable=too-many-locals
     def __call__(self, start: float, stop: float
@@ -75,53 +192,146 @@ class FeaturesBuilder(OrderedDict):  # type: ignore
             sample_rate = self.sample_rate
 
         n_times = sample_rate.to_ind(stop - start)
-        data = torch.zeros((self.dimension, n_times), dtype=torch.float32)
+        data = torch.zeros((self.raw_dimension, n_times), dtype=torch.float32)
         mask = torch.zeros((1, n_times), dtype=torch.float32)
-        select = np.logical_and(self.events._stop >= start, self.events.start < stop)
-        events = self.events.loc[select, :]
+        with profiling.timer("FeaturesBuilder", "select"):
+            select = np.logical_and(self.events._stop >= start, self.events.start < stop)
+            events = self.events.loc[select, :]
 
         # Init data with features default vals
         for feature in self.values():
-            assert data[self.get_slice(feature.name)].shape[0] == feature.dimension
-            data[self.get_slice(feature.name)] = feature.default_value
+            assert data[self.get_slice(feature.name, raw=True)].shape[0] == feature.raw_dimension
+            data[self.get_slice(feature.name, raw=True)] = feature.default_value
 
         dslice = DataSlice(
             start=start, duration=stop - start, sample_rate=sample_rate,
             language=None, modality=None)  # XXX To remove when migrating to Python 3.10
+
+        # Scalar features with precomputed values are rendered at once for all events
+        with profiling.timer("FeaturesBuilder", "select"):
+            first, duration_ind = self._overlap_ranges(events, dslice)
+            kinds = events.kind.values
+        owners: tp.Dict[str, np.ndarray] = {}  # per event kind
+        for name, column in self._precomputed.items():
+            feature = self[name]
+            with profiling.timer(name, "render"):
+                if feature.event_kind not in owners:
+                    owners[feature.event_kind] = self._get_owners(
+                        kinds == feature.event_kind, first, duration_ind, n_times)
+                owner = owners[feature.event_kind]
+                covered = owner >= 0
+                if covered.any():
+                    feature._curr_epoch_stop = stop  # Saved for visualization in notebooks
+                    feature._curr_epoch_start = start  # Saved for visualization in notebooks
+                    values = column[select.values][owner[covered]].astype(np.float32)
+                    data[self.get_slice(name, raw=True)][:, torch.from_numpy(covered)] = \
+                        torch.from_numpy(values)
+
+        # Features computed per stimulus are gathered from their registry at once
+        for name, rows in self._stimulus_rows.items():
+            feature = self[name]
+            with profiling.timer(name, "render"):
+                if feature.event_kind not in owners:
+                    owners[feature.event_kind] = self._get_owners(
+                        kinds == feature.event_kind, first, duration_ind, n_times)
+                owner = owners[feature.event_kind]
+                covered = owner >= 0
+                if covered.any():
+                    feature._curr_epoch_stop = stop  # Saved for visualization in notebooks
+                    feature._curr_epoch_start = start  # Saved for visualization in notebooks
+                    table = self._registries[name].table
+                    assert table is not None
+                    values = table[rows[select.values][owner[covered]]]
+                    data[self.get_slice(name, raw=True)][:, torch.from_numpy(covered)] = \
+                        torch.from_numpy(np.ascontiguousarray(values.T))
+
+        # Populates mask which indicates non-silent parts of the epoch (ones that contain
+        # a stimulus).
+        if self._precomputed_mask is not None:
+            owner = self._get_owners(kinds == self.word_seg_feature.event_kind,
+                                     first, duration_ind, n_times)
+            covered = owner >= 0
+            values = self._precomputed_mask[select.values][owner[covered]].astype(np.float32)
+            mask[:, torch.from_numpy(covered)] = torch.from_numpy(values)
+
+        # Other features are computed event by event
+        generic = [feature for name, feature in self.items()
+                   if name not in self._precomputed and name not in self._stimulus_rows]
+        generic_kinds = {feature.event_kind for feature in generic}
         event_list: tp.List[Event] = [dslice]  # keep total duration for debug
-        for event in events.event.iter():
-            # indices relative to the feature start
+        for index, event in enumerate(events.event.iter()):
             event_list.append(event)
+            if duration_ind[index] < 1 or event.kind not in generic_kinds:
+                continue
             # figure out overlaps
             overlap = dslice.overlap(event)
-            if overlap.duration_ind < 1:
-                continue
-
-            for feature in self.values():
+            assert overlap.duration_ind >= 1
+            for feature in generic:
                 if feature.event_kind == event.kind:
                     feature._curr_epoch_stop = stop  # Saved for visualization in notebooks
                     feature._curr_epoch_start = start  # Saved for visualization in notebooks
-
-                    assert overlap.duration_ind >= 1
-                    val = feature.get_on_overlap(event, overlap)
-                    data[self.get_slice(feature.name), overlap.slice_in_parent()] = val
-
-            # Populates mask which indicates non-silent parts of the epoch (ones that contain
-            # a stimulus).
-            if self.event_mask:
-                if self.word_seg_feature.event_kind == event.kind:
-                    val = self.word_seg_feature.get(event)  # type: ignore
-                    mask[:, overlap.slice_in_parent()] = val
+                    with profiling.timer(feature.name, "get_on_overlap"):
+                        val = feature.get_on_overlap(event, overlap)
+                    data[self.get_slice(feature.name, raw=True), overlap.slice_in_parent()] = val
 
         for feature in self.values():
-            feature.post_process(data[self.get_slice(feature.name)])
+            with profiling.timer(feature.name, "post_process"):
+                feature.post_process(data[self.get_slice(feature.name, raw=True)])
 
         if not self.event_mask:
             mask[:, :] = 1
 
         return data, mask.bool(), event_list
 
-    def get_slice(self, name: str, model_output: bool = False) -> slice:
+    # The slice tables are computed once and invalidated whenever features are added or removed.
+    def __setitem__(self, key: str, value: "Feature") -> None:
+        self._clear_tables()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self._clear_tables()
+        super().__delitem__(key)
+
+    def pop(self, *args: tp.Any) -> tp.Any:
+        self._clear_tables()
+        return super().pop(*args)
+
+    def popitem(self, last: bool = True) -> tp.Any:
+        self._clear_tables()
+        return super().popitem(last=last)
+
+    def setdefault(self, *args: tp.Any) -> tp.Any:
+        self._clear_tables()
+        return super().setdefault(*args)
+
+    def move_to_end(self, key: str, last: bool = True) -> None:
+        self._clear_tables()
+        super().move_to_end(key, last=last)
+
+    def clear(self) -> None:
+        self._clear_tables()
+        super().clear()
+
+    def _clear_tables(self) -> None:
+        self._slice_tables: tp.Dict[tp.Tuple[bool, bool], tp.Dict[str, slice]] = {}
+        self._extract_indices: tp.Dict[tp.Any, torch.Tensor] = {}
+
+    def _get_slice_table(self, model_output: bool, raw: bool) -> tp.Dict[str, slice]:
+        key = (model_output, raw)
+        if key not in self._slice_tables:
+            table = {}
+            start = 0
+            for name, feature in self.items():
+                if model_output:
+                    feature_dim = feature.output_dimension
+                else:
+                    feature_dim = feature.raw_dimension if raw else feature.dimension
+                table[name] = slice(start, start + feature_dim)
+                start += feature_dim
+            self._slice_tables[key] = table
+        return self._slice_tables[key]
+
+    def get_slice(self, name: str, model_output: bool = False, raw: bool = False) -> slice:
         """Returns the slice matching the given feature in the features Tensor.
 
         Parameters
@@ -131,33 +341,35 @@ class FeaturesBuilder(OrderedDict):  # type: ignore
         model_output :
             If true, returns the slice matching feature in the model output. This can be different
             from the features Tensor if the model outputs predictions used for classification.
+        raw :
+            If true, returns the slice matching the feature in the Tensor output by the builder,
+            before `compute_on_device`.
         """
-        if name not in self:
+        table = self._get_slice_table(model_output, raw)
+        if name not in table:
             raise KeyError(f"Could not find feature {name}.")
-        start = 0
-        for key, feature in self.items():
-            feature_dim = feature.output_dimension if model_output else feature.dimension
-            if name == key:
-                break
-            start += feature_dim
-        return slice(start, start + feature_dim)
+        return table[name]
 
     def extract_features(
-            self, features: torch.Tensor, feature_names: tp.Sequence[str]) -> torch.Tensor:
+            self, features: torch.Tensor, feature_names: tp.Sequence[str],
+            raw: bool = False) -> torch.Tensor:
         """Returns a tensor of features containing only the given
         input names from another given feature builder object. Make
         sure to return the tensor in the correct order.
+        If `raw` is true, the features are the ones output by the builder,
+        before `compute_on_device`.
         """
-        assert features.shape[1] == self.dimension, "Input should contain all features"
-        assert all([name in self for name in feature_names])
-
-        extracted_features: tp.List[torch.Tensor] = []
-        for feature_name in feature_names:
-            feature_slice = self.get_slice(feature_name)
-            feature = features[:, feature_slice]
-            extracted_features.append(feature)
-
-        return torch.cat(extracted_features, dim=1)
+        dimension = self.raw_dimension if raw else self.dimension
+        assert features.shape[1] == dimension, "Input should contain all features"
+        table = self._get_slice_table(False, raw)
+        key = (tuple(feature_names), raw, features.device)
+        if key not in self._extract_indices:
+            assert all([name in self for name in feature_names])
+            indices = [index for name in feature_names
+                       for index in range(table[name].start, table[name].stop)]
+            self._extract_indices[key] = torch.tensor(
+                indices, dtype=torch.long, device=features.device)
+        return features.index_select(1, self._extract_indices[key])
 
     @property
     def dimension(self) -> int:
@@ -172,6 +384,27 @@ class FeaturesBuilder(OrderedDict):  # type: ignore
         """
         return sum(feature.output_dimension for feature in self.values())
 
+    @property
+    def raw_dimension(self) -> int:
+        """Returns the sum dimension of all features as output by the builder,
+        before `compute_on_device`.
+        """
+        return sum(feature.raw_dimension for feature in self.values())
+
+    def compute_on_device(self, features: torch.Tensor) -> torch.Tensor:
+        """Computes the features which are only partially computed by the builder
+        (see `Feature.on_device`), on the device of the batch of features.
+        Returns the features with their usual dimensions.
+        """
+        if not any(feature.on_device for feature in self.values()):
+            return features
+        assert features.shape[1] == self.raw_dimension, "Input should contain all features"
+        computed: tp.List[torch.Tensor] = []
+        for name, feature in self.items():
+            data = features[:, self.get_slice(name, raw=True)]
+            computed.append(feature.compute_on_device(data) if feature.on_device else data)
+        return torch.cat(computed, dim=1)
+
     def __reduce__(self) -> tp.Any:
         """This fixes pickling, because we inherit from OrderedDict.
         """
@@ -186,6 +419,9 @@ class Feature:
     cardinality: tp.Optional[int] = None  # if not None, this is treated as a categorical feature
     default_value = 0.
     sample_rate = Frequency(float('NaN'))  # will be overriden
+    # if True, the builder only outputs the inputs of the feature (e.g. a waveform),
+    # and the feature is computed on the training device by `compute_on_device`
+    on_device = False
 
     @classmethod
     def __init_subclass__(cls) -> None:
@@ -214,6 +450,19 @@ class Feature:
         """
         return not self.categorical
 
+    @property
+    def raw_dimension(self) -> int:
+        """Returns the dimension of the feature as output by the builder,
+        which differs from `dimension` for features computed on device.
+        """
+        return self.dimension
+
+    def compute_on_device(self, data: torch.Tensor) -> torch.Tensor:
+        """Computes the feature from a batch of the values output by the builder,
+        of shape [B, raw_dimension, T]. Returns a tensor of shape [B, dimension, T].
+        """
+        raise NotImplementedError
+
     def __init__(self, sample_rate: Frequency) -> None:
         self.sample_rate = sample_rate
         assert self.dimension >= 1
@@ -245,12 +494,24 @@ class Feature:
         val = self.get(event)
         if not isinstance(val, (torch.Tensor, float, int)):
             raise TypeError(f"Invalid type {type(val)} for feature {self}")
-        if isinstance(val, torch.Tensor):
+        return self._truncate_to_overlap(val, event, overlap)
+
+    def _truncate_to_overlap(
+            self, val: tp.Union[float, torch.Tensor, np.ndarray], event: Event,
+            overlap: DataSlice) -> tp.Union[float, torch.Tensor]:
+        """Truncates the value of the feature on the whole event to fit into the DataSlice.
+        A 2D numpy array (e.g. a memmap) is only loaded on the overlap.
+        """
+        if isinstance(val, np.ndarray):
+            assert len(val.shape) == 2, f"Weird shape {val.shape}"
+        if isinstance(val, (torch.Tensor, np.ndarray)):
             if len(val.shape) == 2:
                 assert val.shape[-1] > 0
                 first = max(0, -overlap._sample_rate.to_ind(event.start - overlap.start))
                 first = min(first, val.shape[-1] - 1)
                 val = val[:, first: first + overlap.duration_ind]
+                if isinstance(val, np.ndarray):
+                    val = torch.from_numpy(np.array(val))
                 # data_slice_len is calculated from self.sample_rate.to_ind and can
                 # produce rounding diffe when compared to the output feature dim
                 if (overlap.duration_ind - val.shape[-1]) == 1:
@@ -260,11 +521,44 @@ class Feature:
                         val.unsqueeze(0), (0, 1), mode="replicate").squeeze(0)
                 else:
                     assert val.shape[-1] == overlap.duration_ind
+            assert isinstance(val, torch.Tensor)
             while len(val.shape) < 2:
                 val = val.unsqueeze(-1)
             if len(val.shape) > 2:
                 raise RuntimeError(f"Weird shape {val.shape}")
         return val
 
+    def prepare(self, events: pd.DataFrame) -> None:
+        """Called once by the FeaturesBuilder with all the events of the feature kind,
+        before any call to `get`. Features can override this to precompute in bulk
+        what `get` will need (e.g. filling the cache with batched model calls).
+        With `get_stimulus_keys`, it only receives one event per stimulus missing
+        from the registry.
+        """
+        pass
+
+    def get_values(self, events: pd.DataFrame) -> tp.Optional[np.ndarray]:
+        """For scalar features, optionally computes the values of all the given events at once
+        (same as calling `get` on each of them), which lets the FeaturesBuilder compute them
+        once per recording. Returns None if not supported.
+        """
+        return None
+
+    def get_stimulus_keys(self, events: pd.DataFrame) -> tp.Optional[tp.List[tp.Any]]:
+        """For features which are constant over each event and only depend on its stimulus
+        (e.g. a word in its sentence), optionally returns one hashable key per event
+        identifying the stimulus. The values are then computed once per stimulus and
+        shared across recordings through a `StimulusRegistry`, and the FeaturesBuilder
+        renders them by indexing into it. Returns None if not supported.
+        """
+        return None
+
+    @property
+    def stimulus_args(self) -> tp.Any:
+        """Jsonable parameters of the feature the values of the stimuli depend on,
+        which identify its `StimulusRegistry`.
+        """
+        return None
+
     def post_process(self, tensor: torch.Tensor) -> None:
         pass
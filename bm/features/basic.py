@@ -6,18 +6,27 @@
 """Basic features like word pulse (short burst of 1s on word start).
 """
 
+import functools
 import typing as tp
 
+import numpy as np
+import pandas as pd
 import torch
 
 from .base import Feature
 from ..utils import Frequency
 from .. import events
 
-from wordfreq import zipf_frequency
 from bm.lib.phonemes import ph_dict
 
 
+# words are repeated many times across windows and recordings
+@functools.lru_cache(maxsize=2**16)
+def _zipf_frequency(word: str, language: str) -> float:
+    from wordfreq import zipf_frequency  # lazy import, wordfreq is slow to import
+    return zipf_frequency(word, language)
+
+
 class WordPulse(Feature):
     event_kind = "word"
     normalizable = False
@@ -46,6 +55,9 @@ class PhonemePulse(Feature):
         # Return the phoneme value and convert phonemes to phoneme pulses later at post_process()
         return int(event.phoneme_id) + 1  # 0 is saved for silence
 
+    def get_values(self, events: pd.DataFrame) -> np.ndarray:
+        return events.phoneme_id.values.astype(np.int64) + 1
+
     def post_process(self, tensor: torch.Tensor) -> None:
         """
         Phonemes appear several times in a row in our data. Marks phoneme pulses with '1' only for
@@ -57,24 +69,18 @@ class PhonemePulse(Feature):
         [0,0,1,1,0,0,0,0,1,1,0,0,0,0,0,1,1,0,0,1,1,0,0,0,0,0,0]
         """
         SILENT_PHONEME = 0
-        last_phoneme = SILENT_PHONEME
-        samples_num = tensor.shape[1]
-        for i in range(samples_num):
-            curr_phoneme = tensor[0, i].item()
-            tensor[0, i] = 0
-            if curr_phoneme != last_phoneme:
-                last_phoneme = curr_phoneme
-                if curr_phoneme != SILENT_PHONEME:
-                    tensor[0, i] = 1
+        phonemes = tensor[0]
+        previous = torch.full_like(phonemes, SILENT_PHONEME)
+        previous[1:] = phonemes[:-1]
+        pulses = (phonemes != previous) & (phonemes != SILENT_PHONEME)
 
         pulse_len = max(1, int(self.duration_ms * self.sample_rate / 1000))
-        convert_to_pulse_count = 0
-        for i in range(samples_num - (pulse_len - 1)):
-            if convert_to_pulse_count > 0:
-                tensor[0, i] = 1
-                convert_to_pulse_count -= 1
-            if tensor[0, i] == 1:
-                convert_to_pulse_count = pulse_len - 1
+        stop = phonemes.shape[0] - (pulse_len - 1)
+        if pulse_len > 1 and stop > 0:
+            # Extended samples count as pulse starts themselves, so that a pulse
+            # actually extends up to the last `pulse_len - 1` samples of the window.
+            pulses[:stop] = pulses[:stop].cumsum(0) > 0
+        tensor[0] = pulses.to(tensor.dtype)
 
 
 class WordSegment(Feature):
@@ -87,6 +93,9 @@ class WordSegment(Feature):
     def get(self, event: events.Word) -> int:
         return 1
 
+    def get_values(self, events: pd.DataFrame) -> np.ndarray:
+        return np.ones(len(events), dtype=np.int64)
+
 
 class Modality(Feature):
     """Categorical task feature"""
@@ -100,6 +109,12 @@ class Modality(Feature):
             return 2
         raise RuntimeError("Only audio and visual modalities are supported")
 
+    def get_values(self, events: pd.DataFrame) -> np.ndarray:
+        values = events.modality.map({"audio": 1, "visual": 2})
+        if values.isnull().any():
+            raise RuntimeError("Only audio and visual modalities are supported")
+        return values.values.astype(np.int64)
+
 
 class WordLength(Feature):
     event_kind = "word"
@@ -107,6 +122,9 @@ class WordLength(Feature):
     def get(self, event: events.Word) -> int:
         return len(event.word)
 
+    def get_values(self, events: pd.DataFrame) -> np.ndarray:
+        return np.array([len(word) for word in events.word], dtype=np.int64)
+
 
 class WordIndex(Feature):
     event_kind = "word"
@@ -114,13 +132,22 @@ class WordIndex(Feature):
     def get(self, event: events.Word) -> int:
         return event.word_index + 1
 
+    def get_values(self, events: pd.DataFrame) -> np.ndarray:
+        return events.word_index.values.astype(np.int64) + 1
+
 
 class WordFrequency(Feature):
     event_kind = "word"
 
     def get(self, event: events.Word) -> float:
         assert event.language is not None
-        return float(zipf_frequency(event.word, event.language))
+        return float(_zipf_frequency(event.word, event.language))
+
+    def get_values(self, events: pd.DataFrame) -> np.ndarray:
+        assert events.language.notnull().all()
+        return np.array([_zipf_frequency(word, language)
+                         for word, language in zip(events.word, events.language)],
+                        dtype=np.float64)
 
 
 class Phoneme(Feature):
@@ -135,6 +162,12 @@ class Phoneme(Feature):
             f"Phoneme ID={int(event.phoneme_id)} while cardinality is {self.cardinality}"
         return int(event.phoneme_id) + 1  # 0 is saved for silence
 
+    def get_values(self, events: pd.DataFrame) -> np.ndarray:
+        phoneme_ids = events.phoneme_id.values.astype(np.int64)
+        assert ((0 <= phoneme_ids) & (phoneme_ids < self.cardinality - 1)).all(), \
+            f"Phoneme IDs should be in [0, {self.cardinality - 1}["
+        return phoneme_ids + 1  # 0 is saved for silence
+
 
 class WordHash(Feature):
     """
@@ -154,7 +187,14 @@ class WordHash(Feature):
             self.cardinality = 1 + buckets
 
     def get(self, event: events.Word) -> float:
-        hsh = hash(event.word.lower().strip('.').encode())
+        return self._hash(event.word)
+
+    def _hash(self, word: str) -> int:
+        hsh = hash(word.lower().strip('.').encode())
         if self.buckets is not None:
             hsh = 1 + (hsh % self.buckets)
         return hsh
+
+    def get_values(self, events: pd.DataFrame) -> np.ndarray:
+        hashes = {word: self._hash(word) for word in set(events.word)}
+        return np.array([hashes[word] for word in events.word], dtype=np.int64)
@@ -5,17 +5,20 @@
 # LICENSE file in the root directory of this source tree.
 """Word embedding features.
 """
+import functools
 import logging
 import os
 import typing as tp
 
+import numpy as np
+import pandas as pd
 import spacy
 import torch
-from bm import events
-from bm.cache import Cache, MemoryCache
-from bm.utils import Frequency
+from bm import env, events
+from bm.cache import Cache, MemoryCache, StimulusRegistry
+from bm.utils import CaptureInit, Frequency
 
-from . import base
+from . import base, host
 
 # pylint: disable=import-outside-toplevel
 
@@ -50,12 +53,17 @@ class WordEmbedding(base.Feature):
         if lang == "xx":
             assert self.model_size == "sm", "Multilingual spacy model only available in small"
         self._model_cache = MemoryCache(self.__class__.__name__)
+        # values of the words seen by `prepare`, per language, shared by all the recordings
+        self._vocab: tp.Dict[str, StimulusRegistry] = {}
 
     @property
     def model_name(self):
         # Lazy attribute because LANG can change on the fly.
         assert self._LANG != "auto", "lang not yet set"
-        return f"{VALID_SPACY_LANG[self._LANG]}_{self.model_size}"
+        return self._get_model_name(self._LANG)
+
+    def _get_model_name(self, lang: str) -> str:
+        return f"{VALID_SPACY_LANG[lang]}_{self.model_size}"
 
     @property
     def cache(self):
@@ -64,11 +72,15 @@ class WordEmbedding(base.Feature):
 
     @property
     def model(self) -> tp.Any:
+        return self._get_model(self._LANG)
+
+    def _get_model(self, lang: str) -> tp.Any:
+        name = self._get_model_name(lang)
         try:
-            return self._model_cache.get(spacy.load, name=self.model_name)
+            return self._model_cache.get(spacy.load, name=name)
         except OSError as e:
             raise OSError(
-                f'You need to run "python -m spacy download {self.model_name}"') from e
+                f'You need to run "python -m spacy download {name}"') from e
 
     def _compute(self, word: str) -> torch.Tensor:
         if not word:
@@ -77,14 +89,62 @@ class WordEmbedding(base.Feature):
             out = torch.Tensor(self.model(word)[0].vector)
         return out
 
+    def _compute_vocab(self, lang: str, words: tp.List[str]) -> torch.Tensor:
+        """Computes the values for all the given (non empty) words at once,
+        as a tensor of shape (len(words), dimension).
+        """
+        nlp = self._get_model(lang)
+        # static vectors only need the tokenizer, otherwise vectors come from tok2vec
+        enable = [] if nlp.vocab.vectors_length else [
+            name for name in nlp.pipe_names if name == "tok2vec"]
+        with nlp.select_pipes(enable=enable):
+            vectors = [doc[0].vector for doc in nlp.pipe(words, batch_size=256)]
+        return torch.Tensor(np.stack(vectors))
+
+    def _from_vocab(self, value: torch.Tensor) -> tp.Any:
+        return value
+
+    def prepare(self, events: pd.DataFrame) -> None:
+        """Adds the unique words of the events to the vocabulary table of their language,
+        computing the values of the words not stored yet at once, so that `get` becomes
+        a simple lookup and the spacy model is not needed in the DataLoader workers.
+        """
+        if events.empty:
+            return
+        for lang, words in events.groupby("language").word:
+            if lang not in VALID_SPACY_LANG or self._LANG not in ("auto", lang):
+                continue  # will fail in get
+            vocab = sorted({word for word in words if isinstance(word, str) and word})
+            if not vocab:
+                continue
+            if lang not in self._vocab:
+                self._vocab[lang] = StimulusRegistry.get(
+                    self.__class__.__name__ + "Vocab", self._get_model_name(lang))
+            self._vocab[lang].rows(vocab, functools.partial(self._compute_vocab, lang))
+
     def get(self, event: events.Word) -> torch.Tensor:
         if self._LANG == "auto":
             assert event.language in VALID_SPACY_LANG, f"Invalid lang {event.language}"
             self.__class__._LANG = event.language
         else:
             assert event.language == self._LANG
+        vocab = self._vocab.get(event.language)
+        if vocab is not None and event.word in vocab.index:
+            assert vocab.table is not None
+            value = torch.from_numpy(np.array(vocab.table[vocab.index[event.word]]))
+            return self._from_vocab(value)
         return self.cache.get(self._compute, word=event.word)
 
+    def get_stimulus_keys(self, events: pd.DataFrame) -> tp.Optional[tp.List[tp.Any]]:
+        """The value only depends on the language and the word."""
+        if not all(isinstance(word, str) for word in events.word):
+            return None
+        return list(zip(events.language, events.word))
+
+    @property
+    def stimulus_args(self) -> tp.Any:
+        return self.model_size
+
 
 class WordEmbeddingSmall(WordEmbedding):
     model_size = "sm"
@@ -114,8 +174,18 @@ class PartOfSpeech(WordEmbedding):
             out = self.pos_vocab.index(pos) + 1  # + 1 for silence
         return int(out)
 
+    def _compute_vocab(self, lang: str, words: tp.List[str]) -> torch.Tensor:
+        nlp = self._get_model(lang)
+        disable = [name for name in ("parser", "ner", "lemmatizer") if name in nlp.pipe_names]
+        with nlp.select_pipes(disable=disable):
+            pos = [self.pos_vocab.index(doc[0].pos_) + 1 for doc in nlp.pipe(words)]
+        return torch.Tensor(pos)[:, None]
+
+    def _from_vocab(self, value: torch.Tensor) -> int:
+        return int(value)
+
 
-class BertEmbedding(base.Feature):
+class BertEmbedding(base.Feature, CaptureInit):
     """Multilingual BERT contextual embedding"""
     event_kind = "word"
     dimension = 768
@@ -123,11 +193,12 @@ class BertEmbedding(base.Feature):
     # shared between all instances of one process for memory/speed
 
     def __init__(self, sample_rate: Frequency, device: str = "cpu",
-                 layers: tp.Tuple[int, ...] = (8, 9, 10)) -> None:
+                 layers: tp.Tuple[int, ...] = (8, 9, 10), batch_size: int = 32) -> None:
         super().__init__(sample_rate=sample_rate)
         self.cache = Cache(self.__class__.__name__)
         self.device = device
         self.layers = layers  # layer to extract the embedding from (averaged))
+        self.batch_size = batch_size  # number of sequences per forward in `prepare`
         # Disable Huggingface logging
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
         os.environ["TRANSFORMERS_VERBOSITY"] = "critical"
@@ -166,6 +237,50 @@ class BertEmbedding(base.Feature):
 
         return hiddens, offsets
 
+    def _get_hiddens_batch(
+            self, strings: tp.List[str]) -> tp.List[tp.Tuple[torch.Tensor, torch.Tensor]]:
+        """Batched version of `_get_hiddens`, with the sequences padded to the longest one.
+        """
+        inputs = self.tokenizer(strings,
+                                return_offsets_mapping=True,
+                                return_tensors="pt",
+                                add_special_tokens=True,
+                                padding=True)
+
+        self.model.to(self.device)
+        with torch.no_grad():
+            out = self.model(inputs["input_ids"].to(self.model.device),
+                             attention_mask=inputs["attention_mask"].to(self.model.device),
+                             output_hidden_states=True)
+            hiddens = torch.stack(out.hidden_states).to("cpu")  # (n_layers, n_seq, n_tok, dim)
+            if self.layers is not None:
+                hiddens = hiddens[list(self.layers)]
+            hiddens = hiddens.mean(0)
+            assert hiddens.shape[-1] == self.dimension
+
+        lengths = inputs["attention_mask"].sum(1).tolist()
+        offsets = inputs.offset_mapping[:, :, 1]
+        # clone so that each cached item does not hold the storage of the whole batch
+        return [(hiddens[k, :length].clone(), offsets[k, :length].clone())
+                for k, length in enumerate(lengths)]
+
+    def _bulk_hiddens(self, kwargs_list: tp.List[tp.Dict[str, tp.Any]]) -> tp.List[tp.Any]:
+        compute = host.hosted(self, "_get_hiddens_batch")
+        return compute(strings=[kwargs["string"] for kwargs in kwargs_list])
+
+    def prepare(self, events: pd.DataFrame) -> None:
+        """Computes the hidden states of all the unique word sequences in padded batches.
+        As the cache is keyed on the sequence, sequences shared across recordings
+        are only computed once.
+        """
+        if events.empty or "word_sequence" not in events.columns:
+            return
+        sequences = events.word_sequence[events.word.astype(bool)]
+        unique = {seq for seq in sequences if isinstance(seq, str) and seq}
+        # sorting by length limits the padding within a batch
+        kwargs_list = [dict(string=seq) for seq in sorted(unique, key=lambda x: (len(x), x))]
+        self.cache.precompute(self._bulk_hiddens, kwargs_list, batch_size=self.batch_size)
+
     @property
     def model(self) -> tp.Any:
         from transformers import AutoModel
@@ -176,11 +291,32 @@ class BertEmbedding(base.Feature):
         from transformers import AutoTokenizer
         return self._tokenizer_cache.get(AutoTokenizer.from_pretrained, self.model_name)
 
+    def get_stimulus_keys(self, events: pd.DataFrame) -> tp.Optional[tp.List[tp.Any]]:
+        """The value only depends on the word and its position in the sequence,
+        empty words are mapped to the default value.
+        """
+        if "word_sequence" not in events.columns:
+            return None
+        keys: tp.List[tp.Any] = []
+        for word, index, sequence in zip(events.word, events.word_index, events.word_sequence):
+            if not word:
+                keys.append(None)
+            elif isinstance(word, str) and isinstance(sequence, str) and pd.notnull(index):
+                keys.append((sequence, int(index), word))
+            else:
+                return None
+        return keys
+
+    @property
+    def stimulus_args(self) -> tp.Any:
+        return (self.model_name, self.layers)
+
     def get(self, event: events.Word) -> torch.Tensor:
         if not event.word:
             out = self.default_value
         else:
-            hiddens, offsets = self.cache.get(self._get_hiddens, string=event.word_sequence)
+            hiddens, offsets = self.cache.get(
+                host.hosted(self, "_get_hiddens"), string=event.word_sequence)
             wid = event.word_index
             try:
                 tokens = event.word_sequence.split(" ")
@@ -202,7 +338,7 @@ class BertEmbedding(base.Feature):
         return out
 
 
-class XlmEmbedding(base.Feature):
+class XlmEmbedding(base.Feature, CaptureInit):
     """XLM raw or contextual embeddings
 
     Parameter
@@ -210,44 +346,118 @@ class XlmEmbedding(base.Feature):
     contextual: bool
         use the contextual (final layer) embeddings instead of the raw (first layer)
         embeddings.
+    batch_size: int
+        number of sentences per forward when precomputing the embeddings in `prepare`.
+
+    Note
+    ----
+    If `env.feature_models` contains the extracted `xlmr.large` fairseq archive
+    (`xlmr.large/model.pt`, `dict.txt` and `sentencepiece.bpe.model`), the model is loaded
+    from there instead of through `torch.hub`.
     """
     dimension = 1024
     event_kind = "word"
+    model_name = "xlmr.large"
+    # shared between all instances of one process for memory/speed
     _XLMR: tp.Any = None
 
-    def __init__(self, sample_rate: Frequency, contextual: bool = False) -> None:
+    def __init__(self, sample_rate: Frequency, contextual: bool = False,
+                 batch_size: int = 16) -> None:
         super().__init__(sample_rate=sample_rate)
         self.contextual = contextual
+        self.batch_size = batch_size
         self.cache = Cache(self.__class__.__name__, self.contextual)
+        self._word_tokens: tp.Dict[str, torch.Tensor] = {}
+
+    @classmethod
+    def _load_model(cls) -> tp.Any:
+        folder = None if env.feature_models is None else env.feature_models / cls.model_name
+        if folder is not None and (folder / "model.pt").exists():
+            from fairseq.models.roberta import XLMRModel
+            logger.info(f"Loading {cls.model_name} from {folder}")
+            model = XLMRModel.from_pretrained(str(folder), checkpoint_file="model.pt")
+        else:
+            model = torch.hub.load('pytorch/fairseq', cls.model_name)
+        model.eval()
+        return model
 
-    def _compute(self, string: str) -> torch.Tensor:
+    @property
+    def xlmr(self) -> tp.Any:
         if self._XLMR is None:
-            self.__class__._XLMR = torch.hub.load('pytorch/fairseq', 'xlmr.large')
-            self.__class__._XLMR.eval()
-        xlmr = self.__class__._XLMR
-        # tokenify each word one by one so as to record
-        # which token(s) they are mapped to
+            self.__class__._XLMR = self._load_model()
+        return self._XLMR
+
+    def _encode(self, string: str) -> tp.Tuple[torch.Tensor, tp.List[int]]:
+        """Tokenizes each word one by one so as to record which token(s) they are
+        mapped to. The tokens of each word are memoized, as words are shared
+        across sentences.
+        """
         words = string.split(" ")
         parts: tp.List[torch.Tensor] = []
         affectations = []
         for k, word in enumerate(words):
-            wtokens = xlmr.encode(word)
+            if word not in self._word_tokens:
+                self._word_tokens[word] = self.xlmr.encode(word)
+            wtokens = self._word_tokens[word]
             if not parts:  # add initial token
                 parts.append(wtokens[:1])
             parts.append(wtokens[1:-1])
             affectations.extend([k] * parts[-1].shape[0])
         parts.append(wtokens[-1:])  # add final token
-        tokens = torch.cat(parts)
-        # compute outputs
+        return torch.cat(parts), affectations
+
+    def _compute_batch(
+            self, strings: tp.List[str]) -> tp.List[tp.Tuple[torch.Tensor, torch.Tensor]]:
+        """Computes the embeddings of several sentences at once, padded to the longest one.
+        """
+        encoded = [self._encode(string) for string in strings]
+        pad = self.xlmr.task.source_dictionary.pad()
+        # padding tokens are masked out by fairseq's encoder
+        tokens = torch.nn.utils.rnn.pad_sequence(
+            [toks for toks, _ in encoded], batch_first=True, padding_value=pad)
         with torch.no_grad():
-            all_embs = xlmr.extract_features(tokens, return_all_hiddens=True)
-        embs = (all_embs[-1] if self.contextual else all_embs[0])
-        embs = embs[0, 1:-1, :]  # remove bondaries which are not used
-        assert embs.shape[0] == len(affectations)
-        return embs, torch.Tensor(affectations)
+            all_embs = self.xlmr.extract_features(tokens, return_all_hiddens=True)
+        embs = (all_embs[-1] if self.contextual else all_embs[0]).to("cpu")
+        outputs = []
+        for k, (toks, affectations) in enumerate(encoded):
+            # remove bondaries which are not used, clone so as not to hold the whole batch
+            sembs = embs[k, 1:len(toks) - 1, :].clone()
+            assert sembs.shape[0] == len(affectations)
+            outputs.append((sembs, torch.Tensor(affectations)))
+        return outputs
+
+    def _compute(self, string: str) -> tp.Tuple[torch.Tensor, torch.Tensor]:
+        return self._compute_batch([string])[0]
+
+    def _bulk_compute(self, kwargs_list: tp.List[tp.Dict[str, tp.Any]]) -> tp.List[tp.Any]:
+        compute = host.hosted(self, "_compute_batch")
+        return compute(strings=[kwargs["string"] for kwargs in kwargs_list])
+
+    def prepare(self, events: pd.DataFrame) -> None:
+        """Computes the embeddings of all the unique sentences in padded batches,
+        bucketed by length.
+        """
+        if events.empty or "word_sequence" not in events.columns:
+            return
+        unique = {seq for seq in events.word_sequence if isinstance(seq, str) and seq}
+        # sorting by number of words limits the padding within a batch
+        kwargs_list = [dict(string=seq) for seq in
+                       sorted(unique, key=lambda x: (x.count(" "), len(x), x))]
+        self.cache.precompute(self._bulk_compute, kwargs_list, batch_size=self.batch_size)
 
     def get(self, event: events.Word) -> torch.Tensor:
-        embs, affect = self.cache.get(self._compute, string=event.word_sequence)
+        embs, affect = self.cache.get(host.hosted(self, "_compute"), string=event.word_sequence)
         inds = affect == event.word_index
         # sum and renormalize if the word corresponds to several tokens
         return embs[inds, :].sum(axis=0) / torch.sqrt(sum(inds))
+
+    def get_stimulus_keys(self, events: pd.DataFrame) -> tp.Optional[tp.List[tp.Any]]:
+        """The value only depends on the sequence and the position of the word in it."""
+        if "word_sequence" not in events.columns or events.word_index.isnull().any() or \
+                not all(isinstance(seq, str) for seq in events.word_sequence):
+            return None
+        return list(zip(events.word_sequence, events.word_index.astype(int)))
+
+    @property
+    def stimulus_args(self) -> tp.Any:
+        return (self.model_name, self.contextual)
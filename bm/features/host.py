@@ -0,0 +1,152 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Optional out-of-process host for the models behind the heaviest features
+(Wav2Vec, BERT, XLM-R).
+
+By default, each process (DataLoader workers, `get_datasets` pool) loads its own copy
+of the models. When `env.model_host` is set to the address of a running host, the
+model computations of these features are sent to that single process instead, which
+owns the models and runs the requests one at a time.
+
+Start a host with, e.g.:
+
+    python -m bm.features.host /tmp/bm_model_host.sock --device cuda
+
+and then pass `model_host=/tmp/bm_model_host.sock` to the training command.
+The address is either a path to a unix socket, or `hostname:port`.
+"""
+
+import argparse
+import functools
+import inspect
+import logging
+import os
+import threading
+import typing as tp
+from multiprocessing.managers import BaseManager
+from pathlib import Path
+
+from bm._env import env
+from bm.cache import _get_signature
+
+logger = logging.getLogger(__name__)
+AUTHKEY = b"brainmagick"
+
+
+def _parse_address(address: tp.Any) -> tp.Any:
+    address = str(address)
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return (host, int(port))
+    return address
+
+
+class _Host:
+    """Lives in the host process and holds one feature instance per configuration.
+    """
+
+    def __init__(self, device: tp.Optional[str] = None) -> None:
+        self.device = device
+        self._features: tp.Dict[tp.Tuple[str, str], tp.Any] = {}
+        self._lock = threading.Lock()
+
+    def _get_feature(self, name: str, init_kwargs: tp.Dict[str, tp.Any]) -> tp.Any:
+        from .base import FeaturesBuilder
+        cls = FeaturesBuilder.get_feature_class(name)
+        init_kwargs = dict(init_kwargs)
+        # only explicitly passed kwargs are captured, so check the signature for the device
+        if self.device is not None and "device" in inspect.signature(cls).parameters:
+            init_kwargs["device"] = self.device
+        key = (name, _get_signature({k: v for k, v in init_kwargs.items() if k != "sample_rate"}))
+        if key not in self._features:
+            logger.info("Model host: loading %s(%r)", name, init_kwargs)
+            self._features[key] = cls(**init_kwargs)
+        return self._features[key]
+
+    def call(self, name: str, init_kwargs: tp.Dict[str, tp.Any], method: str,
+             kwargs: tp.Dict[str, tp.Any]) -> tp.Any:
+        # the manager serves each connection in its own thread, models are used one at a time.
+        with self._lock:
+            return getattr(self._get_feature(name, init_kwargs), method)(**kwargs)
+
+
+_HOST: tp.Optional[_Host] = None
+
+
+def _get_host() -> _Host:
+    assert _HOST is not None, "The model host is not initialized"
+    return _HOST
+
+
+class _HostManager(BaseManager):
+    pass
+
+
+_HostManager.register("host", callable=_get_host)
+# one connection per process, as proxies cannot be shared after a fork.
+_CONNECTIONS: tp.Dict[tp.Tuple[int, str], tp.Any] = {}
+
+
+def _connect(address: tp.Any) -> tp.Any:
+    key = (os.getpid(), str(address))
+    if key not in _CONNECTIONS:
+        manager = _HostManager(address=_parse_address(address), authkey=AUTHKEY)
+        manager.connect()
+        _CONNECTIONS[key] = manager.host()  # type: ignore[attr-defined]
+    return _CONNECTIONS[key]
+
+
+def remote_call(feature: tp.Any, method: str, **kwargs: tp.Any) -> tp.Any:
+    """Runs `feature.method(**kwargs)` inside the model host.
+    The feature is rebuilt in the host from its init kwargs (see `bm.utils.CaptureInit`).
+    """
+    assert env.model_host is not None
+    host = _connect(env.model_host)
+    init_kwargs = dict(feature._init_kwargs, sample_rate=feature.sample_rate)
+    return host.call(feature.__class__.__name__, init_kwargs, method, kwargs)
+
+
+def hosted(feature: tp.Any, method: str) -> tp.Callable[..., tp.Any]:
+    """Returns the given method of the feature, or a proxy running it in the model host
+    if `env.model_host` is set.
+    """
+    if env.model_host is None:
+        return getattr(feature, method)
+    return functools.partial(remote_call, feature, method)
+
+
+def serve(address: tp.Any, device: tp.Optional[str] = None) -> None:
+    """Runs the model host until interrupted.
+
+    Parameters
+    ----------
+    address :
+        Path of a unix socket or `hostname:port`.
+    device :
+        If provided, overrides the device of the hosted features (e.g. "cuda").
+    """
+    global _HOST  # pylint: disable=global-statement
+    _HOST = _Host(device=device)
+    manager = _HostManager(address=_parse_address(address), authkey=AUTHKEY)
+    server = manager.get_server()
+    logger.info("Model host listening on %s", address)
+    server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser("bm.features.host", description=__doc__)
+    parser.add_argument("address", help="Path of a unix socket or hostname:port.")
+    parser.add_argument("--device", help="Device to run the models on, e.g. cuda.")
+    parser.add_argument("--feature_models", help="Folder of pre-downloaded feature models.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.feature_models is not None:
+        env.feature_models = Path(args.feature_models)
+    serve(args.address, device=args.device)
+
+
+if __name__ == "__main__":
+    main()
@@ -6,17 +6,26 @@
 
 import os
 import logging
+import multiprocessing
+import pickle
+import subprocess
+import sys
+import time
+import typing as tp
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 import pytest
 import torch
+from torch.nn import functional as F
 
 from bm.utils import Frequency
 from bm import events, play, env
+from bm.cache import StimulusRegistry
 from bm.studies.fake import make_fake_events
-from . import FeaturesBuilder, audio
+from bm.lib.pitch_calc.yin import compute_yin, compute_yin_batched
+from . import FeaturesBuilder, audio, base, host
 
 logger = logging.getLogger(__name__)
 
@@ -45,7 +54,7 @@ def events_df() -> pd.DataFrame:
 def test_builder(start: float, stop: float, events_df) -> None:
     sample_rate = Frequency(100)
     # Xlm requires extra downloads, so let's forget about it
-    features = [x for x in sorted(FeaturesBuilder._FEATURE_CLASSES) if (not x.startswith(
+    features = [x for x in FeaturesBuilder.feature_names() if (not x.startswith(
         "Xlm") and not ("Wav2Vec" in x))]
     features_params = {
         "MelSpectrum": {"n_fft": 100, "n_mels": 8},
@@ -123,10 +132,21 @@ def test_event_filtering(start: float, stop: float, num: int, events_df) -> None
     assert len(events) == num + 1
 
 
-@pytest.mark.parametrize("name", list(FeaturesBuilder._FEATURE_CLASSES))
+@pytest.mark.parametrize("name", FeaturesBuilder.feature_names())
 def test_event_kind_exists(name: str) -> None:
-    cls = FeaturesBuilder._FEATURE_CLASSES[name]
+    cls = FeaturesBuilder.get_feature_class(name)
     assert cls.event_kind in events.EventAccessor.CLASS_KIND_MAPPING.keys()
+    assert cls.__module__ == f"bm.features.{FeaturesBuilder._FEATURE_MODULES[name]}"
+
+
+def test_lazy_features() -> None:
+    code = ("import sys; import bm; from bm.features import FeaturesBuilder; "
+            "heavy = {'spacy', 'wordfreq', 'torchaudio', 'bm.features.audio'}; "
+            "assert not heavy & set(sys.modules), heavy & set(sys.modules); "
+            "FeaturesBuilder.get_feature_class('MelSpectrum'); "
+            "assert 'bm.features.audio' in sys.modules; "
+            "assert 'bm.features.embeddings' not in sys.modules")
+    subprocess.run([sys.executable, "-c", code], check=True)
 
 
 @pytest.mark.parametrize(  # type: ignore
@@ -137,10 +157,198 @@ def test_event_kind_exists(name: str) -> None:
 )
 def test_features(name: str, expected: float, events_df) -> None:
     event = next(events_df.itertuples(index=False))
-    out = FeaturesBuilder._FEATURE_CLASSES[name](sample_rate=Frequency(10)).get(event)
+    out = FeaturesBuilder.get_feature_class(name)(sample_rate=Frequency(10)).get(event)
     assert out == pytest.approx(expected, abs=0.01)
 
 
+@pytest.mark.parametrize("name", ["WordLength", "WordIndex", "WordFrequency", "WordHash",
+                                  "WordSegment", "Modality", "Phoneme", "PhonemePulse"])
+def test_get_values(name: str, events_df) -> None:
+    feature = FeaturesBuilder.get_feature_class(name)(sample_rate=Frequency(10))
+    words = events_df[events_df.kind == feature.event_kind]
+    values = feature.get_values(words)
+    assert values is not None
+    assert values.tolist() == [feature.get(event) for event in words.event.iter()]
+
+
+@pytest.mark.parametrize("sample_rate,expected", [
+    (100, [0, 0, 1, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0]),
+    (125, [0, 0] + [1] * 24 + [0]),
+])
+def test_phoneme_pulse(sample_rate: float, expected) -> None:
+    feature = FeaturesBuilder.get_feature_class("PhonemePulse")(sample_rate=Frequency(sample_rate))
+    tensor = torch.Tensor([[0, 0, 2, 2, 2, 2, 2, 2, 5, 5, 5, 5, 5, 5, 5, 7, 7, 7, 7, 3, 3, 3, 3,
+                            0, 0, 0, 0]])
+    feature.post_process(tensor)
+    assert tensor[0].tolist() == expected
+
+
+def test_builder_overlapping_events() -> None:
+    # later events overwrite earlier ones, for scalar and generic features alike
+    events = make_fake_events(total_duration=5)
+    events = events[events.kind == "word"].iloc[:2].copy()
+    events["start"] = [0.5, 1.0]
+    events["duration"] = [1.0, 1.0]
+    events["word"] = ["hello", "you"]
+    params = {"WordPulse": {"duration_ms": 200}}
+    builder = FeaturesBuilder(events, ["WordLength", "WordPulse"], params,
+                              sample_rate=Frequency(10))
+    data, _, _ = builder(0., 3.)
+    assert data[0].tolist() == [0] * 5 + [5] * 5 + [3] * 10 + [0] * 10
+    assert data[1].tolist() == [0] * 5 + [1, 1, 0, 0, 0] + [1, 1] + [0] * 8 + [0] * 10
+
+
+class _WordStats(base.Feature):
+    # underscore so that it is not registered outside of test_stimulus_registry
+    event_kind = "word"
+    dimension = 2
+    name = "WordStats"  # type: ignore
+
+    def __init__(self, sample_rate: Frequency, per_stimulus: bool = True) -> None:
+        super().__init__(sample_rate)
+        self.per_stimulus = per_stimulus
+        self.calls = 0
+        self.prepared = 0
+
+    def prepare(self, events: pd.DataFrame) -> None:
+        self.prepared += len(events)
+
+    def get(self, event: events.Word) -> torch.Tensor:
+        self.calls += 1
+        return torch.Tensor([len(event.word), event.word_index])
+
+    def get_stimulus_keys(self, events: pd.DataFrame):
+        if not self.per_stimulus:
+            return None
+        return list(zip(events.word, events.word_index))
+
+
+def test_stimulus_registry(events_df, tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setitem(FeaturesBuilder._FEATURE_CLASSES, "WordStats", _WordStats)
+    expected = FeaturesBuilder(events_df, ["WordStats"], {"WordStats": {"per_stimulus": False}},
+                               sample_rate=Frequency(10))(1., 7.)[0]
+    words = events_df[events_df.kind == "word"]
+    num_stimuli = len(set(zip(words.word, words.word_index)))
+    with env.temporary(cache=tmp_path):
+        for calls in [num_stimuli, 0]:  # the second recording only reads the registry
+            builder = FeaturesBuilder(events_df, ["WordStats"], {}, sample_rate=Frequency(10))
+            assert builder["WordStats"].calls == calls
+            data, _, _ = builder(1., 7.)
+            assert builder["WordStats"].calls == calls
+            assert torch.equal(data, expected)
+
+
+def test_stimulus_registry_prepare(events_df, tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setitem(FeaturesBuilder._FEATURE_CLASSES, "WordStats", _WordStats)
+    monkeypatch.setattr(StimulusRegistry, "_REGISTRIES", {})
+    words = events_df[events_df.kind == "word"]
+    num_stimuli = len(set(zip(words.word, words.word_index)))
+    with env.temporary(cache=tmp_path):
+        # registry loaded by a worker before another one fills it
+        stale = StimulusRegistry.get("WordStats")
+        key, = StimulusRegistry._REGISTRIES
+        StimulusRegistry._REGISTRIES.clear()
+        builder = FeaturesBuilder(events_df, ["WordStats"], {}, sample_rate=Frequency(10))
+        assert builder["WordStats"].prepared == num_stimuli  # once per stimulus
+        StimulusRegistry._REGISTRIES.clear()
+        StimulusRegistry._REGISTRIES[key] = stale
+        assert not stale.index
+        other = FeaturesBuilder(events_df, ["WordStats"], {}, sample_rate=Frequency(10))
+        assert other._registries["WordStats"] is stale
+        assert other["WordStats"].prepared == other["WordStats"].calls == 0
+        assert torch.equal(other(1., 7.)[0], builder(1., 7.)[0])
+
+
+def test_word_embedding_vocab(tmp_path: Path, monkeypatch) -> None:
+    from .embeddings import WordEmbedding
+    monkeypatch.setattr(StimulusRegistry, "_REGISTRIES", {})
+    computed: tp.List[str] = []
+
+    def _compute_vocab(self, lang: str, words: tp.List[str]) -> torch.Tensor:
+        computed.extend(words)
+        return torch.Tensor([[len(word)] * self.dimension for word in words])
+
+    monkeypatch.setattr(WordEmbedding, "_compute_vocab", _compute_vocab)
+    sentences = [["the", "cat", "sat"], ["the", "dog", "sat"]]
+    with env.temporary(cache=tmp_path):
+        features = []
+        for sentence in sentences:  # two recordings with different vocabularies
+            feature = WordEmbedding(Frequency(10), lang="en")
+            feature.prepare(pd.DataFrame(dict(word=sentence, language="en")))
+            features.append(feature)
+        assert computed == ["cat", "sat", "the", "dog"]  # each word once
+        feature.prepare(pd.DataFrame(dict(word=["cat"], language="en")))
+        assert len(computed) == 4
+        for word in ["cat", "dog", "the"]:
+            event = events.Word(start=0, duration=1, word=word, word_sequence=word,
+                                word_index=0, modality="audio", language="en")
+            assert feature.get(event).tolist() == [len(word)] * feature.dimension
+        # the table is shared with the pickled copies, e.g. in the DataLoader workers
+        copy = pickle.loads(pickle.dumps(features[0]))
+        assert torch.equal(copy.get(event), feature.get(event))
+
+
+def test_slices(events_df) -> None:
+    params = {"MelSpectrum": {"n_mels": 4}, "WordHash": {"buckets": 10}}
+    builder = FeaturesBuilder(events_df, ["WordLength", "MelSpectrum", "WordHash"], params,
+                              sample_rate=Frequency(10))
+    assert builder.get_slice("WordHash") == slice(5, 6)
+    assert builder.get_slice("WordHash", model_output=True) == slice(5, 16)
+    features = torch.arange(6.)[None, :, None]
+    extracted = builder.extract_features(features, ["WordHash", "MelSpectrum"])
+    assert extracted[0, :, 0].tolist() == [5, 1, 2, 3, 4]
+    # tables are updated when features are removed
+    del builder["WordLength"]
+    assert builder.get_slice("WordHash") == slice(4, 5)
+    with pytest.raises(KeyError):
+        builder.get_slice("WordLength")
+
+
+def test_yin_batched() -> None:
+    rng = np.random.RandomState(12)
+    sig = np.sin(np.arange(8000) * 2 * np.pi * 180 / 16000) + 0.2 * rng.randn(8000)
+    sig[3000:5000] = 0  # silences lead to NaNs
+    kwargs = dict(sr=16000, w_len=256, w_step=64, f0_min=100., f0_max=350.)
+    expected = compute_yin(sig=sig, **kwargs)
+    outputs = compute_yin_batched(sig=sig, batch_size=10, **kwargs)
+    for ref, out in zip(expected, outputs):
+        np.testing.assert_array_equal(np.array(ref), out)
+
+
+@pytest.mark.parametrize("input_size,output_size", [
+    (1, 7), (2, 218), (50, 120), (60, 120), (131, 120), (1479, 3356), (4999, 12000)])
+def test_nearest_indices(input_size: int, output_size: int) -> None:
+    x = torch.rand(2, input_size)
+    expected = F.interpolate(x[None], output_size)[0]
+    indices = audio._nearest_indices(input_size, output_size)
+    assert torch.equal(x[:, indices], expected)
+
+
+def test_nearest_boundaries() -> None:
+    sample_rate = Frequency(49.9)
+    boundaries = np.arange(101) / sample_rate
+    times = np.random.RandomState(0).uniform(-1, 3, size=1000)
+    expected = np.clip(sample_rate.to_ind(times), 0, 100)
+    assert np.array_equal(audio._nearest_boundaries(boundaries, times), expected)
+
+
+def test_mel_on_device() -> None:
+    events = make_fake_events(total_duration=10)
+    outputs = []
+    for on_device in [False, True]:
+        params = {"MelSpectrum": {"n_mels": 20, "on_device": on_device}}
+        builder = FeaturesBuilder(events, ["MelSpectrum", "WordLength"], params,
+                                  sample_rate=Frequency(100))
+        data, _, _ = builder(1., 4.)
+        assert data.shape == (builder.raw_dimension, 300)
+        outputs.append(builder.compute_on_device(data[None])[0])
+    cpu, device = outputs
+    assert cpu.shape == device.shape == (21, 300)
+    assert torch.equal(cpu[-1], device[-1])
+    # the spectrogram is computed on the window instead of the whole file
+    assert np.corrcoef(cpu[:-1].flatten(), device[:-1].flatten())[0, 1] > 0.99
+
+
 def test_sentence_builder() -> None:
     builder = play.SentenceFeatures(
         ["WordPulse", "WordFrequency", "WordLength"], features_params={}, sample_rate=20)
@@ -158,7 +366,7 @@ def test_xlr_embedding(sentence: str) -> None:
     word = sentence.split()[1]
     event = events.Word(start=0, duration=1, word=word, word_sequence=sentence, word_index=1,
                         modality="visual", language="nl")
-    feature = FeaturesBuilder._FEATURE_CLASSES["XlmEmbedding"](sample_rate=Frequency(10))
+    feature = FeaturesBuilder.get_feature_class("XlmEmbedding")(sample_rate=Frequency(10))
     out = feature.get(event)
     assert isinstance(out, torch.Tensor)
     assert out.shape == (feature.dimension,)
@@ -181,3 +389,80 @@ def test_wav2vec(cls, tmp_path: Path) -> None:
         out = feature.get_on_overlap(event, overlap)
         assert isinstance(out, torch.Tensor)
         assert out.shape == (feature.dimension, 100)
+
+
+def test_wav2vec_cached_frames_read_only(tmp_path: Path) -> None:
+    wavpath = str(Path(__file__).parent.parent / "mockdata" / "one_two.wav")
+    event = events.Sound(start=1, duration=1, filepath=wavpath, modality=None, language=None)
+    overlap = events.DataSlice(
+        start=event.start, duration=1.0, sample_rate=50, modality=None, language=None)
+    with env.temporary(cache=tmp_path):
+        feature = audio.Wav2VecConvolution(sample_rate=Frequency(50))
+        kwargs = dict(start=event.offset, stop=event.offset + event.duration,
+                      filepath=event.filepath, name="extract_features", layers=None)
+        path = feature.cache.cache_path(kwargs)
+        assert path is not None
+        expected = np.random.rand(1, 50, 512).astype(np.float32)
+        feature.cache._save(path, expected)  # no model needed
+        out = feature.get_on_overlap(event, overlap)
+        assert out.shape == (512, 50)
+        out += 1  # modifying the output does not alter the cache
+        np.testing.assert_array_equal(np.load(path), expected)
+
+
+def test_wav2vec_cached_frames_bounded(tmp_path: Path, monkeypatch) -> None:
+    monkeypatch.setattr(audio._BaseWav2Vec, "_MAX_FRAMES", 4)
+    wavpath = str(Path(__file__).parent.parent / "mockdata" / "one_two.wav")
+    with env.temporary(cache=tmp_path):
+        feature = audio.Wav2VecConvolution(sample_rate=Frequency(50))
+        num_fds = len(os.listdir("/proc/self/fd")) if os.path.exists("/proc/self/fd") else 0
+        for k in range(20):
+            event = events.Sound(start=1, duration=0.1, offset=k / 100, filepath=wavpath,
+                                 modality=None, language=None)
+            kwargs = dict(start=event.offset, stop=event.offset + event.duration,
+                          filepath=event.filepath, name="extract_features", layers=None)
+            path = feature.cache.cache_path(kwargs)
+            assert path is not None
+            expected = np.full((1, 5, 512), k, dtype=np.float32)
+            feature.cache._save(path, expected)
+            overlap = events.DataSlice(start=event.start, duration=event.duration,
+                                       sample_rate=50, modality=None, language=None)
+            for _ in range(2):
+                out = feature.get_on_overlap(event, overlap)
+                assert out.shape == (512, 5)
+                assert (out == k).all()
+        assert len(feature._frames) == 4
+        if num_fds:  # each memmap holds an open file
+            assert len(os.listdir("/proc/self/fd")) <= num_fds + 4
+
+
+def test_model_host(tmp_path: Path) -> None:
+    address = str(tmp_path / "host.sock")
+    server = multiprocessing.Process(target=host.serve, args=(address,), daemon=True)
+    server.start()
+    try:
+        for _ in range(100):
+            if Path(address).exists():
+                break
+            time.sleep(0.05)
+        wavpath = Path(__file__).parent.parent / "mockdata" / "one_two.wav"
+        feature = audio.Pitch(sample_rate=Frequency(100))
+        expected = feature._compute(filepath=wavpath, start=0.0, stop=1.0)
+        with env.temporary(model_host=address):
+            compute = host.hosted(feature, "_compute")
+            assert compute is not feature._compute
+            out = compute(filepath=wavpath, start=0.0, stop=1.0)
+        torch.testing.assert_close(out, expected)
+    finally:
+        server.terminate()
+
+
+def test_model_host_device(tmp_path: Path) -> None:
+    with env.temporary(cache=tmp_path):
+        model_host = host._Host(device="cuda")
+        # the device is not among the captured kwargs, it defaults to cpu
+        feature = model_host._get_feature("Wav2VecConvolution", dict(sample_rate=Frequency(100)))
+        assert feature.device == "cuda"
+        # features without device are left untouched
+        assert isinstance(model_host._get_feature("Pitch", dict(sample_rate=Frequency(100))),
+                          audio.Pitch)
@@ -170,3 +170,82 @@ def compute_yin(sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500,
             harmonic_rates[i] = min(cmdf)
 
     return pitches, harmonic_rates, argmins, times
+
+
+def compute_yin_batched(sig, sr, w_len=512, w_step=256, f0_min=100, f0_max=500,
+                        harmo_thresh=0.1, batch_size=512):
+    """
+    Same as `compute_yin`, but all the frames of a batch are processed at once with numpy
+    (a single batched rFFT, vectorized CMND and threshold search) instead of one by one,
+    which is much faster on long signals. Outputs are numpy arrays.
+    :param batch_size: number of frames processed at once, to bound memory.
+    """
+    sig = np.asarray(sig)
+    tau_min = int(sr / f0_max)
+    tau_max = int(sr / f0_min)
+
+    starts = np.arange(0, len(sig) - w_len, w_step)  # time values for each analysis window
+    times = starts / float(sr)
+    pitches = np.zeros(len(starts))
+    harmonic_rates = np.zeros(len(starts))
+    argmins = np.zeros(len(starts))
+    if not len(starts):
+        return pitches, harmonic_rates, argmins, times
+    all_frames = np.lib.stride_tricks.sliding_window_view(sig, w_len)[::w_step][:len(starts)]
+
+    for first in range(0, len(starts), batch_size):
+        batch = slice(first, first + batch_size)
+        frames = all_frames[batch].astype(np.float64)
+        df = _batched_difference_function(frames, tau_max)
+        cmdf = _batched_cmndf(df, tau_max)
+        p = _batched_get_pitch(cmdf, tau_min, tau_max, harmo_thresh)
+
+        argmin = np.argmin(cmdf, axis=1)
+        valid = argmin > tau_min
+        argmins[batch][valid] = sr / argmin[valid]
+        voiced = p != 0
+        pitches[batch][voiced] = sr / p[voiced]
+        # cmdf[:, 0] is always 0, so nanmin matches the min of the NaN-skipping loop.
+        rates = np.nanmin(cmdf, axis=1)
+        rates[voiced] = cmdf[voiced, p[voiced]]
+        harmonic_rates[batch] = rates
+
+    return pitches, harmonic_rates, argmins, times
+
+
+def _batched_difference_function(x, tau_max):
+    """Batched version of `differenceFunction` over frames x of shape (n_frames, w)."""
+    w = x.shape[-1]
+    tau_max = min(tau_max, w)
+    x_cumsum = np.concatenate((np.zeros((len(x), 1)), (x * x).cumsum(axis=-1)), axis=-1)
+    size = w + tau_max
+
+    p2 = (size // 32).bit_length()
+    nice_numbers = (16, 18, 20, 24, 25, 27, 30, 32)
+    size_pad = min(xxx * 2 ** p2 for xxx in nice_numbers if xxx * 2 ** p2 >= size)
+    fc = np.fft.rfft(x, size_pad, axis=-1)
+    conv = np.fft.irfft(fc * fc.conjugate(), axis=-1)[:, :tau_max]
+    return (x_cumsum[:, w:w - tau_max:-1] + x_cumsum[:, w:w + 1] - x_cumsum[:, :tau_max] -
+            2 * conv)
+
+
+def _batched_cmndf(df, N):
+    """Batched version of `cumulativeMeanNormalizedDifferenceFunction`."""
+    csm = np.cumsum(df[:, 1:], axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cmndf = df[:, 1:] * np.arange(1, N) / csm
+    return np.concatenate((np.zeros((len(df), 1)), cmndf), axis=-1)
+
+
+def _batched_get_pitch(cmdf, tau_min, tau_max, harmo_th=0.1):
+    """Batched version of `getPitch`, returns 0 for unvoiced frames."""
+    taus = np.arange(tau_min, tau_max)
+    below = cmdf[:, tau_min:tau_max] < harmo_th
+    voiced = below.any(axis=1)
+    # first tau under the threshold, then follow the descent to the local minimum.
+    first = tau_min + np.argmax(below, axis=1)
+    stop = np.ones_like(below)
+    stop[:, :-1] = ~(cmdf[:, tau_min + 1:tau_max] < cmdf[:, tau_min:tau_max - 1])
+    stop &= taus >= first[:, None]
+    tau = tau_min + np.argmax(stop, axis=1)
+    return np.where(voiced, tau, 0)
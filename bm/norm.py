@@ -194,7 +194,7 @@ class BatchScaler:
                 recording_index = batch.recording_index[0].item()
                 assert (batch.recording_index == recording_index).all()
                 all_meg[recording_index].append(batch.meg)
-                all_features.append(batch.features)
+                all_features.append(self.features_builder.compute_on_device(batch.features))
                 all_mask.append(batch.features_mask)
                 if remaining <= 0:
                     break
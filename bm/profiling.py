@@ -0,0 +1,149 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+"""Opt-in profiling of the features extraction.
+
+When enabled (`profile_features=true` in the config), the FeaturesBuilder records the wall
+time and number of calls of each step of each feature (events selection, `get_on_overlap`,
+`post_process`...), and `Cache` records its hits and misses. The statistics of each process,
+including the DataLoader workers, are regularly dumped into a shared folder, so that
+`log_report` can aggregate them all.
+"""
+import contextlib
+import logging
+import os
+import pickle
+import tempfile
+import time
+import typing as tp
+from multiprocessing import util
+from pathlib import Path
+
+from .utils import write_and_rename
+
+logger = logging.getLogger(__name__)
+Stats = tp.Dict[tp.Tuple[str, str], tp.List[float]]  # (name, step) -> [calls, seconds]
+
+
+class _Profiler:
+    """Statistics of the current process."""
+
+    def __init__(self) -> None:
+        self.folder: tp.Optional[Path] = None
+        self.stats: Stats = {}
+        self._pid = os.getpid()
+        self._last_dump = time.time()
+        self.reported: Stats = {}  # aggregated statistics at the time of the last report
+
+    @property
+    def enabled(self) -> bool:
+        return self.folder is not None
+
+    def record(self, name: str, step: str, duration: float) -> None:
+        if os.getpid() != self._pid:
+            # forked process (e.g. DataLoader worker), start from fresh statistics.
+            self._pid = os.getpid()
+            self.stats = {}
+            util.Finalize(None, self.dump, exitpriority=10)
+        stat = self.stats.setdefault((name, step), [0, 0.])
+        stat[0] += 1
+        stat[1] += duration
+        if time.time() - self._last_dump > 1.:
+            self.dump()
+
+    def dump(self) -> None:
+        if self.folder is None or os.getpid() != self._pid:
+            return
+        self._last_dump = time.time()
+        with write_and_rename(self.folder / f"{self._pid}.pkl") as f:
+            pickle.dump(self.stats, f)
+
+
+_PROFILER = _Profiler()
+
+
+def enable(folder: tp.Optional[Path] = None) -> None:
+    """Enables profiling in this process and the processes it forks."""
+    if folder is None:
+        folder = Path(tempfile.mkdtemp(prefix="bm_profile_"))
+    folder.mkdir(exist_ok=True, parents=True)
+    _PROFILER.folder = folder
+    _PROFILER.stats = {}
+    _PROFILER.reported = {}
+
+
+def disable() -> None:
+    _PROFILER.folder = None
+
+
+def enabled() -> bool:
+    return _PROFILER.enabled
+
+
+@contextlib.contextmanager
+def timer(name: str, step: str) -> tp.Iterator[None]:
+    """Records the time spent in the context for the given step of `name`."""
+    if not _PROFILER.enabled:
+        yield
+        return
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        _PROFILER.record(name, step, time.perf_counter() - begin)
+
+
+def record(name: str, step: str, duration: float = 0.) -> None:
+    if _PROFILER.enabled:
+        _PROFILER.record(name, step, duration)
+
+
+def get_stats() -> Stats:
+    """Returns the statistics aggregated over all the processes."""
+    if _PROFILER.folder is None:
+        return {}
+    _PROFILER.dump()
+    total: Stats = {}
+    for path in _PROFILER.folder.glob("*.pkl"):
+        try:
+            with open(path, "rb") as f:
+                stats = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            continue
+        for key, (calls, seconds) in stats.items():
+            stat = total.setdefault(key, [0, 0.])
+            stat[0] += calls
+            stat[1] += seconds
+    return total
+
+
+def format_report(stats: Stats) -> str:
+    lines = [f"{'name':<28} {'step':<16} {'calls':>10} {'total (s)':>10} {'mean (ms)':>10}"]
+    for (name, step), (calls, seconds) in sorted(stats.items(), key=lambda x: -x[1][1]):
+        lines.append(f"{name:<28} {step:<16} {int(calls):>10} {seconds:>10.2f} "
+                     f"{1000 * seconds / max(1, calls):>10.3f}")
+    caches = sorted({name for name, step in stats if step in ("hit", "miss")})
+    for name in caches:
+        hits = stats.get((name, "hit"), [0, 0.])[0]
+        misses = stats.get((name, "miss"), [0, 0.])[0]
+        lines.append(f"{name}: hit rate {hits / max(1, hits + misses):.1%} "
+                     f"({int(hits)} hits, {int(misses)} misses)")
+    return "\n".join(lines)
+
+
+def log_report(title: str) -> None:
+    """Logs the statistics aggregated over all processes since the last report,
+    if profiling is enabled.
+    """
+    if not _PROFILER.enabled:
+        return
+    stats = get_stats()
+    delta = {}
+    for key, (calls, seconds) in stats.items():
+        previous = _PROFILER.reported.get(key, [0, 0.])
+        if calls > previous[0]:
+            delta[key] = [calls - previous[0], seconds - previous[1]]
+    _PROFILER.reported = stats
+    logger.info("Features profiling (%s):\n%s", title, format_report(delta))
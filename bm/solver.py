@@ -15,6 +15,7 @@ from torch import nn
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
 
+from . import profiling
 from .cache import Cache
 from .dataset import SegmentBatch
 from .losses import ClipLoss, FeatureDecodingLoss, L1Loss, L2Loss
@@ -73,6 +74,11 @@ class Solver(flashy.BaseSolver):
 
         self.negative_pool = self._make_negative_pool()
 
+    def run_stage(self, stage_name, method, *args, **kwargs):
+        metrics = super().run_stage(stage_name, method, *args, **kwargs)
+        profiling.log_report(stage_name)
+        return metrics
+
     def _create_loss(self, loss: str):
         if loss == 'l1':
             return L1Loss()
@@ -241,6 +247,8 @@ class Solver(flashy.BaseSolver):
         task = args.task
         sample_rate = args.dset.sample_rate
         batch = batch.to(self.device)
+        # features computed on device, e.g. MelSpectrum with on_device=True
+        batch = batch.replace(features=self.used_features.compute_on_device(batch.features))
 
         if self.scale_reject:
             batch, reject_mask = self.scale_reject(batch)
@@ -13,4 +13,4 @@ from . import lebel2023  # noqa
 from . import schoffelen2019  # noqa
 
 # flake8: noqa
-from .api import Recording, from_selection, register
+from .api import RawMemmap, Recording, from_selection, register
@@ -4,10 +4,13 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import contextlib
 import copy
 import inspect
 import logging
+import math
 import typing as tp
+from fractions import Fraction
 from pathlib import Path
 
 import julius
@@ -19,8 +22,11 @@ import yaml
 
 import bm
 from bm import env
+from bm.utils import write_and_rename
 
 logger = logging.getLogger(__name__)
+# event columns with few distinct values, stored as categories in the events cache
+CATEGORICAL_COLUMNS = ("kind", "modality", "language", "condition")
 
 
 def _give_permission(filepath: tp.Optional[Path]) -> None:
@@ -140,7 +146,7 @@ class Recording:
         self._recording_index: tp.Optional[int] = None  # specified during training
         self._mne_info: tp.Optional[mne.Info] = None
         # cache system
-        self._arrays: tp.Dict[tp.Tuple[int, float], mne.io.RawArray] = {}
+        self._arrays: tp.Dict[tp.Tuple[float, float], mne.io.BaseRaw] = {}
         self._events: tp.Optional[pd.DataFrame] = None
 
         if env.cache is None:
@@ -210,7 +216,9 @@ class Recording:
     ) -> mne.io.RawArray:
         """Creates and/or loads the data at a given sampling rate.
         1200Hz sample_rate with no highpass (0) would return the raw,
-        different values would create a subsampled fif file and load it from the cache.
+        different values would create a subsampled file and load it from the cache.
+        The intermediate data without highpass is cached as well, so that other variants
+        can be derived from it (see `_preprocess`).
 
         Parameter
         ---------
@@ -224,10 +232,12 @@ class Recording:
         key: tp.Tuple[float, float] = (sample_rate, highpass)
         if key in self._arrays:
             return self._arrays[key]
-        name = f"meg-sr{sample_rate}-hp{highpass}-raw.fif"
-        filepath = None if self._cache_folder is None else self._cache_folder / name
+        name = f"meg-sr{sample_rate}-hp{highpass}"
+        filepath = None if self._cache_folder is None else self._cache_folder / f"{name}.npy"
+        # caches created before the memmap format
+        fif_filepath = None if filepath is None else filepath.with_name(f"{name}-raw.fif")
         # check is frequency matches raw
-        if filepath is None or not filepath.exists():
+        if filepath is None or not (filepath.exists() or fif_filepath.exists()):  # type: ignore
             raw = self.raw()
             if raw.info["sfreq"] == sample_rate:
                 key = (0, highpass)
@@ -241,25 +251,60 @@ class Recording:
                 "No cache folder provided for intermediate "
                 f"(subsampled at {sample_rate}Hz) storage."
             )
-        assert filepath is not None
-        if not filepath.exists():
-            low_mne = preprocess_mne(
-                self.raw(), sample_rate=sample_rate, highpass=highpass
-            )
-            low_mne.save(str(filepath), overwrite=True)
-            _give_permission(filepath)  # for sharing
-        self._arrays[key] = mne.io.read_raw_fif(str(filepath), preload=False)
+        assert filepath is not None and fif_filepath is not None
+        if fif_filepath.exists() and not filepath.exists():
+            self._arrays[key] = mne.io.read_raw_fif(str(fif_filepath), preload=False)
+        else:
+            if not filepath.exists():
+                self._preprocess(sample_rate, highpass=highpass, filepath=filepath)
+                _give_permission(RawMemmap.info_path(filepath))
+                _give_permission(filepath)  # for sharing
+            self._arrays[key] = RawMemmap(filepath)
         self.mne_info  # populate mne info cache.
         return self._arrays[key]
 
+    def _preprocess(self, sample_rate: float, highpass: float, filepath: Path) -> None:
+        """Preprocesses the data into the given .npy file (see `RawMemmap`). Highpass
+        variants are filtered from the data without highpass at the same sample rate
+        (cached as well), which is always resampled from the raw. This fixed chain makes
+        each cached file independent of which other files were in the cache.
+        """
+        source = self.preprocessed(sample_rate) if highpass else self.raw()
+        preprocess_mne(source, sample_rate=sample_rate, highpass=highpass, filepath=filepath)
+
+    def preprocessed_array(
+        self, sample_rate: tp.Optional[float] = None, highpass: float = 0
+    ) -> np.ndarray:
+        """Same as `preprocessed`, but returns the data as an array of shape
+        [channels, time], which is a read-only float32 memmap on the cache
+        if the data was preprocessed.
+        """
+        raw = self.preprocessed(sample_rate, highpass=highpass)
+        if isinstance(raw, RawMemmap):
+            return raw.memmap
+        return raw.get_data()
+
     @staticmethod
     def _read_from_cache(cache_file: Path) -> pd.DataFrame:
+        if cache_file.suffix == ".feather":
+            events = _feather().read_table(cache_file, memory_map=True).to_pandas()
+            events = events.fillna(np.nan)  # missing strings are read as None
+            # categories are a storage detail, they would change the behavior of
+            # concatenations and groupbys downstream
+            for name in CATEGORICAL_COLUMNS:
+                if name in events and isinstance(events[name].dtype, pd.CategoricalDtype):
+                    events[name] = events[name].astype(object)
+            return events
         return pd.read_csv(cache_file, index_col=None)
 
     @staticmethod
     def _write_to_cache(events: pd.DataFrame, cache_file: Path) -> None:
         assert isinstance(events, pd.DataFrame)
-        events.to_csv(cache_file, index=False)
+        if cache_file.suffix == ".feather":
+            with write_and_rename(cache_file, pid=True) as f:
+                _feather().write_feather(_to_feather_dtypes(events), f)
+        else:
+            events.to_csv(cache_file, index=False)
         _give_permission(cache_file)
 
     # pylint: disable=unused-argument
@@ -276,11 +321,17 @@ class Recording:
             if self._cache_folder is None:
                 self._events = self._load_events()
             else:
-                cache_file = self._cache_folder / "events.csv"
+                csv_file = self._cache_folder / "events.csv"
+                cache_file = csv_file
+                if _feather() is not None:
+                    cache_file = csv_file.with_suffix(".feather")
                 if cache_file.exists():
                     self._events = self._read_from_cache(cache_file)
                 else:
-                    self._events = self._load_events()
+                    if csv_file.exists():  # cache created before the feather format
+                        self._events = self._read_from_cache(csv_file)
+                    else:
+                        self._events = self._load_events()
                     self._write_to_cache(self._events, cache_file)
         events = self._events
 
@@ -351,11 +402,111 @@ class Recording:
 #         return super_blocks
 
 
+class RawMemmap(mne.io.BaseRaw):
+    """Preprocessed recording stored as a .npy float32 array of shape [channels, time],
+    along with a fif file holding its `mne.Info`. The data is read lazily through a memmap,
+    which is much faster than the fif reader. Use `raw.save` to export it as a .fif file.
+    """
+
+    def __init__(self, filepath: Path) -> None:
+        info = mne.io.read_info(str(self.info_path(filepath)), verbose=False)
+        shape = np.load(filepath, mmap_mode="r").shape
+        cals = np.array([ch["range"] * ch["cal"] for ch in info["chs"]])
+        super().__init__(info, preload=False, last_samps=(shape[1] - 1,),
+                         filenames=(str(filepath),), raw_extras=[dict(cals=cals)],
+                         verbose=False)
+
+    @staticmethod
+    def info_path(filepath: Path) -> Path:
+        return filepath.with_name(filepath.stem + "-info.fif")
+
+    @classmethod
+    @contextlib.contextmanager
+    def writer(cls, filepath: Path, info: mne.Info, num_times: int) -> tp.Iterator[np.ndarray]:
+        """Yields the float32 memmap of shape [channels, time] to fill, which is stored
+        along with the info when the context exits.
+        """
+        info_path = cls.info_path(filepath)
+        if info_path.exists():
+            info_path.unlink()
+        mne.io.write_info(str(info_path), info)
+        # the data is written last, as its existence marks the cache as complete
+        with write_and_rename(filepath, pid=True) as f:
+            data = np.lib.format.open_memmap(
+                f.name, mode="w+", dtype=np.float32, shape=(len(info["ch_names"]), num_times))
+            yield data
+            data.flush()
+            del data
+
+    @classmethod
+    def create(cls, raw: mne.io.BaseRaw, filepath: Path,
+               chunk_duration: float = 60.) -> "RawMemmap":
+        """Saves the data of the raw in the memmap format chunk by chunk, and opens it"""
+        chunk = max(1, int(chunk_duration * raw.info["sfreq"]))
+        with cls.writer(filepath, raw.info, raw.n_times) as data:
+            for start in range(0, raw.n_times, chunk):
+                data[:, start: start + chunk] = raw.get_data(start=start, stop=start + chunk)
+        return cls(filepath)
+
+    @property
+    def memmap(self) -> np.ndarray:
+        """The read-only data, of shape [channels, time]"""
+        return np.load(self.filenames[0], mmap_mode="r")
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):  # type: ignore
+        # the memmap holds the calibrated data, while mne expects it uncalibrated
+        memmap = np.load(self._filenames[fi], mmap_mode="r")
+        one = memmap[:, start: stop] / self._raw_extras[fi]["cals"][:, None]
+        if mult is not None:
+            data[:] = mult @ one[idx]
+        else:
+            data[:] = one[idx] * cals
+
+
+def _feather() -> tp.Any:
+    """Returns the `pyarrow.feather` module used for caching the events, or None if
+    pyarrow is not available, in which case the events are cached as csv.
+    """
+    try:
+        from pyarrow import feather
+    except ImportError:
+        return None
+    return feather
+
+
+def _to_feather_dtypes(events: pd.DataFrame) -> pd.DataFrame:
+    """Explicit dtypes for storing the events with feather: object columns
+    with mixed types (e.g. paths, or strings and numbers) are converted to strings,
+    as when reading back a csv, and the string columns of `CATEGORICAL_COLUMNS`
+    are stored as categories.
+    """
+    import pyarrow as pa
+    events = events.reset_index(drop=True)
+    for name, column in events.items():
+        if column.dtype != object:
+            continue
+        try:
+            pa.array(column, from_pandas=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            events[name] = column = column.where(column.isna(), column.astype(str))
+        if name in CATEGORICAL_COLUMNS:
+            events[name] = column.astype("category")
+    return events
+
+
+def _integer_rates(old_sr: float, new_sr: float) -> tp.Tuple[int, int]:
+    """Integer sample rates with the same ratio, as required by julius."""
+    ratio = Fraction(old_sr).limit_denominator(1000) / Fraction(new_sr).limit_denominator(1000)
+    return ratio.numerator, ratio.denominator
+
+
 def preprocess_mne(
     raw: mne.io.RawArray,
     sample_rate: float = 200,
     highpass: float = 0,
-) -> mne.io.RawArray:
+    chunk_duration: float = 60.,
+    filepath: tp.Optional[Path] = None,
+) -> mne.io.BaseRaw:
     """Creates a new mne.io.RawArray at another sampling rate
     Parameter:
     raw: mne.io.RawArray
@@ -364,29 +515,82 @@ def preprocess_mne(
         the required sample rate for the new mne array
     highpass: int
         the frequency of the highpass filter (no high pass filter if 0)
+    chunk_duration: float
+        duration (in seconds) of the chunks of the recording processed at once.
+        Chunks are extended with the context needed by the filters, so that the output
+        does not depend on it, and memory does not grow with the recording length
+        (apart from the output itself).
+    filepath: Path or None
+        if provided, the output is written chunk by chunk to this .npy file and returned
+        as a RawMemmap, so that the memory does not grow with the recording length at all.
     """
     old_sr = raw.info["sfreq"]
     if sample_rate > old_sr:
         logger.warning(
             f"Data sample rate is {old_sr}Hz so it is not subsampled to {sample_rate}Hz"
         )
+        if filepath is not None:
+            return RawMemmap.create(raw, filepath, chunk_duration=chunk_duration)
         return raw
     else:
         # raise ValueError(
         #     f"The sample rate should be below {old_sr}Hz, got {sample_rate}Hz"
         # )
-        data = torch.Tensor(raw.get_data())
-        resamp = julius.ResampleFrac(old_sr=old_sr, new_sr=sample_rate)
-        data = resamp(data)
-        if highpass:
-            data -= julius.lowpass_filter(data, highpass / sample_rate)
-
+        resamp = julius.ResampleFrac(*_integer_rates(old_sr, sample_rate))
+        # the input is processed by blocks of resamp.old_sr samples, which give
+        # resamp.new_sr output samples each.
+        block = resamp.old_sr
+        num_blocks = max(1, int(chunk_duration * old_sr) // block)
+        context = block * math.ceil(getattr(resamp, "_width", 0) / block)
+        length = raw.n_times
+        out_length = int(resamp.new_sr * length / resamp.old_sr)
         info_kwargs = dict(raw.info)
         info_kwargs["sfreq"] = sample_rate
         info = mne.Info(**info_kwargs)
         # check that layout works
         layout = mne.find_layout(info)  # noqa
-        return mne.io.RawArray(data.numpy(), info=info)
+        with contextlib.ExitStack() as stack:
+            if filepath is None:
+                # float64 as mne.io.RawArray would convert to it anyway
+                data = np.empty((len(raw.ch_names), out_length))
+            else:
+                data = stack.enter_context(RawMemmap.writer(filepath, info, out_length))
+            for start in range(0, length, num_blocks * block):
+                stop = min(start + num_blocks * block, length)
+                # the edges of the recording are padded by julius, as for the whole recording
+                first = max(0, start - context)
+                last = min(length, stop + context)
+                chunk = resamp(torch.Tensor(raw.get_data(start=first, stop=last)))
+                out_start = start // block * resamp.new_sr
+                out_stop = min(out_length, stop // block * resamp.new_sr) if stop < length \
+                    else out_length
+                skip = (start - first) // block * resamp.new_sr
+                data[:, out_start: out_stop] = chunk[:, skip: skip + out_stop - out_start].numpy()
+            if highpass:
+                _chunked_highpass(data, highpass / sample_rate,
+                                  chunk=max(1, int(chunk_duration * sample_rate)))
+        if filepath is not None:
+            return RawMemmap(filepath)
+        return mne.io.RawArray(data, info=info)
+
+
+def _chunked_highpass(data: np.ndarray, cutoff: float, chunk: int) -> None:
+    """Subtracts in place the lowpass filtered signal (as julius.lowpass_filter),
+    computed chunk by chunk with the context needed by the filter on both sides.
+    """
+    length = data.shape[-1]
+    lowpass = julius.LowPassFilters([cutoff])
+    context = lowpass.half_size
+    previous = np.empty((data.shape[0], 0))  # unfiltered signal right before the chunk
+    for start in range(0, length, chunk):
+        stop = min(start + chunk, length)
+        unfiltered = np.concatenate([previous, data[:, start: min(length, stop + context)]], 1)
+        offset = previous.shape[1]
+        end = offset + stop - start
+        previous = unfiltered[:, max(0, end - context): end]
+        signal = torch.Tensor(unfiltered)
+        filtered = signal - lowpass(signal)[0]
+        data[:, start: stop] = filtered[:, offset: end].numpy()
 
 
 def list_selections() -> tp.List[tp.Tuple[tp.Type[Recording], tp.Dict[str, tp.Any]]]:
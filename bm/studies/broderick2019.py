@@ -18,7 +18,6 @@ from zipfile import ZipFile
 import mne
 import numpy as np
 import pandas as pd
-import spacy
 from scipy.io import loadmat
 
 from ..events import extract_sequence_info
@@ -162,6 +161,7 @@ class _BroderickMetadata:
 
         # lazy init
         if not hasattr(self, "nlp"):
+            import spacy  # slow to import
             self.nlp = spacy.load(SPACY_MODEL)
             self._cache: dict = dict()
 
@@ -230,6 +230,7 @@ class Broderick2019Recording(api.Recording):
         # download, extract, organize
         paths = get_paths()
         _prepare()
+        import spacy  # slow to import
         if not spacy.util.is_package(SPACY_MODEL):
             spacy.cli.download(SPACY_MODEL)
 
@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 # Author: kingjr, 2020
 
+import functools
 import logging
 from pathlib import Path
 import typing as tp
@@ -102,22 +103,13 @@ def _clean_log(log):
         log.loc[sel, "condition"] = value
     log.loc[log.Code == "", "condition"] = "blank"
 
-    # Annotate sequence idx and extend context to all trials
-    start = 0
-    block = 0
-    context = "init"
-    log["new_context"] = False
-    query = 'condition in ("word_list", "sentence")'
-    for row in log.query(query).itertuples():
-        idx = row.Index
-        log.loc[start:idx, "context"] = context
-        log.loc[start:idx, "block"] = block
-        log.loc[idx, "new_context"] = True
-        context = row.condition
-        block += 1
-        start = idx
-    log.loc[start:, "context"] = context
-    log.loc[start:, "block"] = block
+    # Annotate sequence idx and extend context to all trials: each row belongs to the
+    # context started by the last context row (included), or "init" before the first one.
+    log["new_context"] = log.condition.isin(("word_list", "sentence"))
+    contexts = np.r_[["init"], log.condition[log.new_context].values].astype(object)
+    block = np.searchsorted(np.flatnonzero(log.new_context), np.arange(len(log)), side="right")
+    log["context"] = contexts[block]
+    log["block"] = block.astype(float)
 
     # Format time
     log.loc[:, "Time"] = [0.0 if not isinstance(x, (int, float)) else x for x in log.Time]
@@ -216,9 +208,9 @@ def _map_phonemes_to_ids(phonemes_list):
     return _map_phonemes_to_ids_internal(phonemes_list, ph_dict)
 
 
-def tgrid_to_dict(fname: str) -> tp.List[tp.Dict[str, tp.Any]]:
-    """Parse TextGrid Praat file and generates a dataframe containing both
-    words and phonemes"""
+# the same audio files are heard by all the subjects of the auditory task
+@functools.lru_cache(maxsize=1024)
+def _read_tgrid(fname: str) -> pd.DataFrame:
     tgrid = textgrid.read_textgrid(fname)  # type: ignore
     parts: tp.Dict[str, tp.Any] = {}
     for p in tgrid:
@@ -231,42 +223,37 @@ def tgrid_to_dict(fname: str) -> tp.List[tp.Dict[str, tp.Any]]:
     phonemes_ids = _map_phonemes_to_ids(phonemes)
     assert len(phonemes) == len(phonemes_ids)
 
-    # Def concatenate orthographics and phonetics
-    rows: tp.List[tp.Dict[str, tp.Any]] = []
-    for word_index, word in enumerate(words):
-        rows.append(
-            dict(
-                event_type="word",
-                start=word.start,
-                stop=word.stop,
-                word_index=word_index,
-                word=word.name,
-                modality="audio",
-            )
-        )
-
-    # Add timing of individual phonemes
-    starts = np.array([i["start"] for i in rows])
-    # phonemes and starts are both ordered so this could be further optimized if need be
-    for phoneme, ph_id in zip(phonemes, phonemes_ids):
-        idx = np.where(phoneme.start < starts)[0]
-        idx = idx[0] - 1 if idx.size else len(rows) - 1
-        row = rows[idx]
-        rows.append(
-            dict(
-                event_type="phoneme",
-                start=phoneme.start + 1e-6,
-                stop=phoneme.stop,
-                word_index=row["word_index"],
-                word=row["word"],
-                phoneme=phoneme.name,
-                phoneme_id=ph_id,
-                modality="audio",
-            )
-        )
+    # Each phoneme belongs to the last word starting before it. Phonemes before the first
+    # word or after the start of the last one keep the word of the previous phoneme
+    # (the last word for the first phoneme), as in the initial implementation.
+    word_starts = np.array([word.start for word in words], dtype=float)
+    phoneme_starts = np.array([phoneme.start for phoneme in phonemes], dtype=float)
+    following = np.searchsorted(word_starts, phoneme_starts, side="right")
+    inside = (following > 0) & (following < len(words))
+    phoneme_words = pd.Series(np.where(inside, following - 1, np.nan))
+    phoneme_words = phoneme_words.ffill().fillna(len(words) - 1).values.astype(int)
+    word_index = np.r_[np.arange(len(words)), phoneme_words]
+    nans = np.full(len(words), np.nan)
+
+    # Concatenate orthographics and timing of individual phonemes
+    df = pd.DataFrame(dict(
+        event_type=["word"] * len(words) + ["phoneme"] * len(phonemes),
+        start=np.r_[word_starts, phoneme_starts + 1e-6],
+        stop=np.array([x.stop for x in words + phonemes], dtype=float),
+        word_index=word_index,
+        word=np.array([word.name for word in words], dtype=object)[word_index],
+        modality="audio",
+        phoneme=np.r_[nans.astype(object), [phoneme.name for phoneme in phonemes]],
+        phoneme_id=np.r_[nans, phonemes_ids],
+    ))
     # not sure why sorting is needed, but otherwise a sample is dropped
-    rows.sort(key=lambda x: float(x["start"]))
-    return rows
+    return df.sort_values("start", kind="stable", ignore_index=True)
+
+
+def tgrid_to_df(fname: str) -> pd.DataFrame:
+    """Parse TextGrid Praat file and generates a dataframe containing both
+    words and phonemes (the parsing is cached across calls)"""
+    return _read_tgrid(fname).copy()
 
 
 def _add_phonemes(log: pd.DataFrame, phonemes_path: tp.Optional[Path] = None) -> pd.DataFrame:
@@ -275,49 +262,43 @@ def _add_phonemes(log: pd.DataFrame, phonemes_path: tp.Optional[Path] = None) ->
     if phonemes_path is None:
         phonemes_path = StudyPaths.phoneme_file(0).parent
 
-    # Add audio file name across dataframe
-    file_ = np.nan
-    prev_start = 0
-    prev_stop = 0
-
-    log["sequence_id"] = np.nan
-    starts = np.where(log.word.apply(lambda x: "Start File" in str(x)))[0]
-    stops = np.where(log.word.apply(lambda x: "End of file" in str(x)))[0]
-
+    # Add audio file name across dataframe, from each "Start File" to its "End of file"
+    words = log.word.astype(str)
+    starts = np.flatnonzero(words.str.contains("Start File", regex=False))
+    stops = np.flatnonzero(words.str.contains("End of file", regex=False))
     assert len(starts) == len(stops)
-
-    for start, stop in zip(starts, stops):
-        # set file to previous rows
-        log.loc[slice(prev_start, prev_stop), "sequence_id"] = file_
-        # update file name
-        file_ = int(log.loc[start, "word"].split()[-1][:-4])
-        prev_start, prev_stop = start, stop
-    log.loc[slice(prev_start, prev_stop), "sequence_id"] = file_
+    files = words.iloc[starts].str.split().str[-1].str[:-4].astype(int).values
+    file_index = np.searchsorted(starts, np.arange(len(log)), side="right") - 1
+    in_file = file_index >= 0
+    in_file[in_file] = np.arange(len(log))[in_file] <= stops[file_index[in_file]]
+    sequence_ids = np.full(len(log), np.nan)
+    sequence_ids[in_file] = files[file_index[in_file]]
+    log["sequence_id"] = sequence_ids
 
     # For each audio file, add timing of words and phonemes
-    starts = np.where(log.word == "Audio onset")[0]
-    rows: tp.List[tp.Dict[str, tp.Any]] = []  # faster than appending on the fly
-    for start in starts:
-        row = log.loc[start, :]
-        if not row.condition == "sound":  # should be used for SentenceWavFeature
-            raise RuntimeError(f"Unexpected condition {row.condition}")
-        fname = (
-            str(phonemes_path) + "/EQ_Ramp_Int2_Int1LPF%.3i.TextGrid" % row.sequence_id
+    starts = np.flatnonzero(log.word == "Audio onset")
+    conditions = log.condition.iloc[starts]
+    if not (conditions == "sound").all():  # should be used for SentenceWavFeature
+        raise RuntimeError(f"Unexpected condition {conditions[conditions != 'sound'].iloc[0]}")
+    onsets = log.iloc[starts]
+    contents = [_read_tgrid(str(phonemes_path) + "/EQ_Ramp_Int2_Int1LPF%.3i.TextGrid" % sid)
+                for sid in onsets.sequence_id]
+    if contents:
+        content = pd.concat(contents, ignore_index=True)
+        rows = onsets.iloc[np.repeat(np.arange(len(onsets)), [len(c) for c in contents])]
+        content = content.assign(
+            subject=rows.subject.values, trial=rows.trial.values, stim_type="sound",
+            context=rows.context.values, block=rows.block.values,
+            sequence_id=rows.sequence_id.values,
+            duration=content.stop - content.start,
+            filepath=rows.filepath.values,
+            time=rows.time.values + content.start,  # audio onset
         )
-        content = tgrid_to_dict(fname)
-        for d in content:
-            d.update(subject=row.subject, trial=row.trial, stim_type="sound",
-                     context=row.context, block=row.block, sequence_id=row.sequence_id,
-                     duration=d["stop"] - d["start"],
-                     filepath=row.filepath,
-                     time=row.time + d["start"]
-                     )  # audio onset
-        log.loc[start, "start"] = 0
-        duration = content[-1]["stop"]
-        log.loc[start, "stop"] = duration
-        log.loc[start, "duration"] = duration
-        rows.extend(content)
-    log = pd.concat([log, pd.DataFrame(rows)], ignore_index=True, sort=False)
+        durations = [c.stop.iloc[-1] for c in contents]
+        log.loc[onsets.index, "start"] = 0
+        log.loc[onsets.index, "stop"] = durations
+        log.loc[onsets.index, "duration"] = durations
+        log = pd.concat([log, content], ignore_index=True, sort=False)
 
     # homogeneize names
     for condition in ("word", "phoneme"):
@@ -367,7 +348,6 @@ def get_log_times(log: pd.DataFrame, events: np.ndarray, sfreq: float) -> pd.Dat
 
     last_log = common_logs.time.values[0]
     last_meg = common_megs[0, 0]
-    last_idx = 0
 
     # TODO FIXME match_list may be based on too few elements, and
     # generate random timings, hence the assert > 40 (chosen arbitrarily)
@@ -389,32 +369,32 @@ def get_log_times(log: pd.DataFrame, events: np.ndarray, sfreq: float) -> pd.Dat
     common_logs = common_logs.iloc[idx_logs]
 
     assert len(common_megs) == len(common_logs)
-    for common_meg, common_log in zip(
-        common_megs, common_logs.itertuples()
-    ):
-        idx = common_log.Index
-        if common_meg[2] == 20:
-            assert common_log.condition == "fix"
-        else:
-            assert common_log.condition in ("sentence", "word_list")
-
-        log.loc[idx, "meg_time"] = common_meg[0] / sfreq
-
-        sel = slice(last_idx + 1, idx)
-        times = log.loc[sel, "time"] - last_log + last_meg / sfreq
-        assert np.all(np.isfinite(times.astype(float)))
-        log.loc[sel, "meg_time"] = times
-
-        last_log = common_log.time
-        last_meg = common_meg[0]
-        last_idx = idx
-
-        assert np.isfinite(last_log) * np.isfinite(last_meg)
-
-    # last block
-    sel = slice(last_idx + 1, None)
-    times = log.loc[sel, "time"] - last_log + last_meg / sfreq
-    log.loc[sel, "meg_time"] = times
+    is_fix = common_megs[:, 2] == 20
+    assert (common_logs.condition[is_fix] == "fix").all()
+    assert common_logs.condition[~is_fix].isin(("sentence", "word_list")).all()
+    anchor_logs = common_logs.time.to_numpy(dtype=float)
+    anchor_megs = common_megs[:, 0]
+    assert np.all(np.isfinite(anchor_logs))
+
+    # The rows following an anchor, up to the next anchor (included, as label slices),
+    # are shifted by the log-to-meg offset of this anchor. Positions are computed from the
+    # labels since the index of the auditory logs is not sorted.
+    last_logs = np.r_[last_log, anchor_logs]
+    last_megs = np.r_[last_meg, anchor_megs]
+    last_idxs = np.r_[0, common_logs.index.values]
+    bounds = [log.index.slice_indexer(start + 1, stop)
+              for start, stop in zip(last_idxs, common_logs.index)]
+    bounds.append(log.index.slice_indexer(last_idxs[-1] + 1, None))
+    anchors = np.r_[log.index.get_indexer(common_logs.index), -1]
+    times = log.time.to_numpy(dtype=float)
+    meg_times = np.full(len(log), np.nan)
+    for k, bound in enumerate(bounds):
+        if k < len(common_logs):
+            meg_times[anchors[k]] = anchor_megs[k] / sfreq
+        shifted = times[bound] - last_logs[k] + last_megs[k] / sfreq
+        assert k == len(common_logs) or np.all(np.isfinite(shifted))
+        meg_times[bound] = shifted
+    log["meg_time"] = meg_times
     log.meg_time = log.meg_time.fillna(-1)
     log["meg_sample"] = np.array(log.meg_time.values * sfreq, int)
 
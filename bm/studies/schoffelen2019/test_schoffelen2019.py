@@ -37,10 +37,33 @@ def test_tgrid_to_df() -> None:
     data_path = Path(__file__).parent.with_name("mockdata") / "full_example.TextGrid"
     if not data_path.exists():
         raise SkipTest("Full text grid example not commited.")
-    df = preproc.tgrid_to_dict(str(data_path))
+    df = preproc.tgrid_to_df(str(data_path))
     test_api.cached_assert_df_equal(df, "expected_full_example.csv")
 
 
+def test_tgrid_to_df_cached() -> None:
+    fname = str(Path(__file__).parents[2] / "mockdata" / "example.TextGrid")
+    df = preproc.tgrid_to_df(fname)
+    assert df.event_type.tolist() == ["word", "phoneme", "phoneme", "word"]
+    assert df.word_index.tolist() == [0, 0, 0, 1]
+    assert df.phoneme.tolist()[1:3] == ["t", "Y"]
+    df.loc[:, "word"] = "modified"
+    # parsed once, but each call gets its own copy
+    assert preproc.tgrid_to_df(fname).word.tolist() == ["Toen", "Toen", "Toen", "de"]
+
+
+def test_clean_log_contexts() -> None:
+    codes = ["blank", "ZINNEN", "FIX 1", "12 hello", "WOORDEN", "FIX 2", "3 word"]
+    log = pd.DataFrame(dict(Code=codes, Time=[float(k) for k in range(len(codes))]))
+    log = preproc._clean_log(log)
+    # context rows start their own context
+    assert log.context.tolist() == ["init", "sentence", "sentence", "sentence",
+                                    "word_list", "word_list", "word_list"]
+    assert log.block.tolist() == [0, 1, 1, 1, 2, 2, 2]
+    assert log.new_context.tolist() == [False, True, False, False, True, False, False]
+    assert log.word.tolist()[3::3] == ["hello", "word"]
+
+
 # To bo fixed
 def test_get_all_recordings() -> None:
     with mock.patch.object(schoffelen2019.StudyPaths, 'is_valid', return_value=True):
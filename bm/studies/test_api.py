@@ -4,13 +4,18 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import io
 import logging
 import tempfile
 import typing as tp
 import unittest
 from pathlib import Path
+import julius
+import mne
+import numpy as np
 import pytest
 import pandas as pd
+import torch
 from bm import env
 from bm import studies
 from . import api
@@ -117,3 +122,78 @@ def test_no_iterrows() -> None:
 def test_list_selections() -> None:
     selections = api.list_selections()
     assert len(selections) > 5
+
+
+@pytest.mark.parametrize("old_sr,sample_rate,highpass", [
+    (1200., 120, 0.), (1200., 200, 1.), (1017.25, 100, 0.5)])
+def test_preprocess_mne_chunks(old_sr: float, sample_rate: float, highpass: float,
+                               tmp_path: Path) -> None:
+    info = mne.create_info(3, old_sr, "mag")
+    data = np.random.RandomState(0).randn(3, int(30 * old_sr) + 7)
+    raw = mne.io.RawArray(data, info, verbose=False)
+    resample = julius.ResampleFrac(*api._integer_rates(old_sr, sample_rate))
+    expected = resample(torch.Tensor(data))
+    if highpass:
+        expected -= julius.lowpass_filter(expected, highpass / sample_rate)
+    out = api.preprocess_mne(raw, sample_rate, highpass, chunk_duration=2.)
+    assert out.info["sfreq"] == sample_rate
+    np.testing.assert_allclose(out.get_data(), expected.numpy(), atol=1e-5)
+    # written chunk by chunk to a memmap
+    stored = api.preprocess_mne(raw, sample_rate, highpass, chunk_duration=2.,
+                                filepath=tmp_path / "meg.npy")
+    assert isinstance(stored, api.RawMemmap)
+    np.testing.assert_array_equal(stored.memmap, out.get_data().astype(np.float32))
+
+
+def test_preprocessed_intermediates(tmp_path: Path, monkeypatch: tp.Any) -> None:
+    sources = []
+    preprocess_mne = api.preprocess_mne
+
+    def _preprocess_mne(raw: mne.io.BaseRaw, sample_rate: float,
+                        highpass: float = 0, **kwargs: tp.Any) -> mne.io.BaseRaw:
+        sources.append((raw.info["sfreq"], sample_rate, highpass))
+        return preprocess_mne(raw, sample_rate=sample_rate, highpass=highpass, **kwargs)
+
+    monkeypatch.setattr(api, "preprocess_mne", _preprocess_mne)
+    with env.temporary(cache=tmp_path / "fake_cache_intermediates"):
+        recording = api.register["fake"]("sub-A2002")  # type: ignore
+        recording.preprocessed(100)
+        recording.preprocessed(50, highpass=1)
+        other = api.register["fake"]("sub-A2002")  # type: ignore
+        data = other.preprocessed_array(25)
+        other.preprocessed(50, highpass=1)  # cached
+        # highpass variants are derived from the same rate, resampled from the raw
+        assert sources == [(1200, 100, 0), (1200, 50, 0), (50, 50, 1), (1200, 25, 0)]
+        # whatever was already in the cache
+        expected = preprocess_mne(other.raw(), sample_rate=25).get_data()
+        np.testing.assert_array_equal(data, expected.astype(np.float32))
+
+
+def test_events_cache(tmp_path: Path) -> None:
+    assert api._feather() is not None, "pyarrow is required for the events cache"
+    with env.temporary(cache=tmp_path / "fake_cache_events"):
+        recording = api.register["fake"]("sub-A2002")  # type: ignore
+        events = recording.events()
+        cached = api.register["fake"]("sub-A2002").events()  # type: ignore
+    assert recording._cache_folder is not None
+    assert (recording._cache_folder / "events.feather").exists()
+    # same content as with the csv cache
+    expected = pd.read_csv(io.StringIO(events.to_csv(index=False)))
+    pd.testing.assert_frame_equal(cached, expected, check_dtype=False)
+
+
+def test_events_cache_dtypes(tmp_path: Path) -> None:
+    events = pd.DataFrame(dict(
+        kind=["word", "sound", np.nan],
+        filepath=[np.nan, Path("a.wav"), Path("b.wav")],
+        word=["hello", 12, np.nan],
+        word_index=[0, 1, 2],
+        start=[0.5, np.nan, 1.5],
+        valid=[True, False, True],
+    ))
+    api.Recording._write_to_cache(events, tmp_path / "events.feather")
+    cached = api.Recording._read_from_cache(tmp_path / "events.feather")
+    # same as with the csv cache: mixed objects are read back as strings
+    expected = pd.read_csv(io.StringIO(events.to_csv(index=False)))
+    pd.testing.assert_frame_equal(cached, expected)
+    assert cached.kind.dtype == object
@@ -0,0 +1,109 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import pickle
+from concurrent import futures
+from pathlib import Path
+
+import numpy as np
+
+import torch
+
+from bm import env
+from bm.cache import Cache, StimulusRegistry
+
+
+def test_cache_precompute(tmp_path: Path) -> None:
+    calls = []
+
+    def _bulk(kwargs_list):
+        calls.append(len(kwargs_list))
+        return [torch.tensor(float(len(kwargs["string"]))) for kwargs in kwargs_list]
+
+    def _single(string):
+        raise AssertionError("Should be cached")
+
+    with env.temporary(cache=tmp_path):
+        cache = Cache("test", "args")
+        cache.precompute(_bulk, [dict(string=s) for s in ["a", "bb", "ccc"]], batch_size=2)
+        assert calls == [2, 1]
+        assert cache.get(_single, string="bb").item() == 2
+        # only missing keys are computed
+        cache.precompute(_bulk, [dict(string=s) for s in ["a", "dddd"]], batch_size=2)
+        assert calls == [2, 1, 1]
+        assert cache.get(_single, string="dddd").item() == 4
+
+
+def test_cache_memmap_read_only(tmp_path: Path) -> None:
+    with env.temporary(cache=tmp_path):
+        cache = Cache("test", "args", mode="memmap")
+        cache.get(lambda size: np.arange(size), size=4)
+        loaded = cache.get(lambda size: np.zeros(size), size=4)
+        assert isinstance(loaded, np.memmap)
+        assert not loaded.flags.writeable
+        assert loaded.tolist() == [0, 1, 2, 3]
+
+
+def test_stimulus_registry(tmp_path: Path) -> None:
+    def _compute(keys):
+        return np.array([[len(key), index] for key, index in keys])
+
+    with env.temporary(cache=tmp_path):
+        registry = StimulusRegistry("test", "args")
+        rows = registry.rows([("a", 0), ("bb", 1), ("a", 0)], _compute)
+        assert rows.tolist() == [0, 1, 0]
+        assert registry.table is not None
+        assert registry.table[rows].tolist() == [[1, 0], [2, 1], [1, 0]]
+        # reloaded from disk, only the missing keys are computed
+        other = StimulusRegistry("test", "args")
+        assert other.rows([("ccc", 2), ("bb", 1)], _compute).tolist() == [2, 1]
+        assert isinstance(other.table, np.memmap)
+        unpickled = pickle.loads(pickle.dumps(other))
+        assert np.array_equal(unpickled.table, other.table)
+        assert StimulusRegistry.get("test", "args") is StimulusRegistry.get("test", "args")
+
+
+def _add_to_registry(cache: Path, keys) -> list:
+    with env.temporary(cache=cache):
+        registry = StimulusRegistry("test", "args")
+        rows = registry.rows(keys, lambda keys: np.array([[float(key)] for key in keys]))
+        return [registry.index[key] for key in keys] + rows.tolist()
+
+
+def test_stimulus_registry_concurrent(tmp_path: Path) -> None:
+    def _compute(keys):
+        return np.array([[float(key)] for key in keys])
+
+    with env.temporary(cache=tmp_path):
+        first = StimulusRegistry("test", "args")
+        second = StimulusRegistry("test", "args")
+        assert first.rows([1], _compute).tolist() == [0]
+        # the second registry does not know about the row added by the first one
+        assert second.rows([2, 1], _compute).tolist() == [1, 0]
+        first = pickle.loads(pickle.dumps(first))
+        assert first.table is not None
+        assert first.table[first.rows([1, 2], _compute)].ravel().tolist() == [1, 2]
+    with futures.ProcessPoolExecutor(4) as pool:
+        jobs = [pool.submit(_add_to_registry, tmp_path, list(range(k, k + 20)))
+                for k in range(0, 80, 10)]
+        results = [job.result() for job in jobs]
+    with env.temporary(cache=tmp_path):
+        registry = StimulusRegistry("test", "args")
+        assert registry.table is not None
+        assert len(registry.index) == 90
+        assert registry.table[registry.rows(list(range(90)), _compute)].ravel().tolist() == \
+            list(range(90))
+        for k, rows in zip(range(0, 80, 10), results):
+            assert rows[:20] == rows[20:] == [registry.index[key] for key in range(k, k + 20)]
+        # the files are rebuilt with other rows: pickled registries are re-mapped
+        state = pickle.dumps(registry)
+        assert registry.path is not None
+        for path in registry.path.parent.iterdir():
+            path.unlink()
+        StimulusRegistry("test", "args").rows(list(range(90))[::-1], _compute)
+        unpickled = pickle.loads(state)
+        assert unpickled.table[unpickled.rows(list(range(90)), _compute)].ravel().tolist() == \
+            list(range(90))
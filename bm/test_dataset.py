@@ -4,10 +4,12 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 
+import pickle
 from pathlib import Path
 import warnings
 from unittest import mock
 
+import mne
 import numpy as np
 import torch
 from torch.utils.data import ConcatDataset
@@ -83,6 +85,28 @@ def test_epochs_dataset_slicing(tmp_path: Path) -> None:
     assert out.features.shape[0] == num
 
 
+def test_memmap_direct_read(tmp_path: Path) -> None:
+    with env.temporary(cache=tmp_path / "fake_cache_memmap"):
+        recording = studies.register["fake"]("sub-A2002")  # type: ignore
+        recording._subject_index = 0  # needs to be initialized
+        recording._recording_index = 0  # needs to be initialized
+        for baseline in [(None, 0), None]:
+            fact = dset.SegmentDataset.Factory(
+                condition="word", tmin=-0.5, tmax=0.5, sample_rate=200, baseline=baseline)
+            ds = fact.apply(recording)
+            assert ds is not None
+            assert isinstance(ds.epochs._raw, studies.RawMemmap)
+            assert ds._direct_read
+            for k in range(len(ds)):
+                np.testing.assert_allclose(ds._get_meg(k), next(ds.epochs[k]), atol=1e-18)
+            assert pickle.loads(pickle.dumps(ds))._memmap is None
+        # the recording can still be exported to fif for mne tooling
+        raw = recording.preprocessed(200)
+        raw.save(tmp_path / "export-raw.fif")
+        exported = mne.io.read_raw_fif(tmp_path / "export-raw.fif", verbose=False)
+        np.testing.assert_allclose(exported.get_data(), raw.get_data(), rtol=1e-6)
+
+
 def test_get_datasets(tmp_path: Path) -> None:
     with warnings.catch_warnings():
         warnings.simplefilter("error")  # make sure no warning is triggerred
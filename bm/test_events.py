@@ -13,7 +13,8 @@ import pandas as pd
 import matplotlib as mpl
 
 from .events import (
-    Event, DataSlice, Sound, extract_sequence_info, split_wav_as_block, assign_blocks)
+    Event, DataSlice, Sound, Word, EventAccessor, extract_sequence_info, split_wav_as_block,
+    assign_blocks)
 
 
 @pytest.fixture
@@ -51,6 +52,17 @@ def test_extract_sequence_info(event_dicts) -> None:
     assert (out.loc[out.kind == 'phoneme', 'phoneme_id'] == 0).all()
 
 
+def test_extract_sequence_info_multiple_words(event_dicts) -> None:
+    events_df = pd.DataFrame(event_dicts)
+    events_df.loc[0, ['kind', 'word']] = ['multiplewords', 'ceci est']
+    events_df.loc[3:4, 'word_index'] = [10, 11]  # provided indices are kept
+    out = extract_sequence_info(events_df, word=True, phoneme=False)
+    is_word = out.kind.isin(['word', 'multiplewords'])
+    assert out.loc[is_word, 'word_index'].tolist() == [0, 2, 10, 11]
+    assert out.loc[is_word, 'word_sequence'].tolist() == ['ceci est est'] * 2 + ['un test'] * 2
+    assert 'phoneme_id' not in out
+
+
 def test_event_accessor_validate(event_dicts) -> None:
     events_df = pd.DataFrame(event_dicts)
     events_df = extract_sequence_info(events_df)
@@ -90,6 +102,23 @@ def test_event_accessor_invalid_duration(events_df) -> None:
         events_df.event.validate()
 
 
+def test_event_accessor_validated_marker(events_df, monkeypatch) -> None:
+    assert events_df.attrs[EventAccessor.VALIDATED_ATTR]
+    calls = []
+    validate_frame = Word._validate_frame.__func__  # type: ignore
+
+    def _validate_frame(cls, frame):
+        calls.append(len(frame))
+        return validate_frame(cls, frame)
+
+    monkeypatch.setattr(Word, "_validate_frame", classmethod(_validate_frame))
+    events_df[events_df.kind == 'word'].event.iter()
+    events_df.copy().event.create_blocks(groupby='sentence')
+    assert not calls
+    events_df.event.validate()  # explicit validation is always run
+    assert calls == [4]
+
+
 def test_event_accessor_iter(events_df) -> None:
     for i, event in enumerate(events_df.event.iter()):
         assert isinstance(event, Event)
@@ -107,6 +136,19 @@ def test_event_accessor_create_blocks(events_df) -> None:
     assert blocks.iloc[0].uid == 'ceci est'
 
 
+def test_create_blocks_uids(events_df) -> None:
+    events = events_df.copy()
+    # unique in the first block only
+    events['sequence_uid'] = np.where(events.sequence_id == 0, 'first', events.word)
+    out = events.event.create_blocks(groupby='sentence')
+    assert out[out.kind == 'block'].uid.tolist() == ['first', 'un test']
+    # the sound overlaps both sentences, so it is only used for sound blocks
+    out = events_df.event.create_blocks(groupby='sound')
+    blocks = out[out.kind == 'block']
+    assert len(blocks) == 1
+    assert blocks.iloc[0].uid == 'ceci est un test'
+
+
 def test_event_accessor_merge_blocks(events_df) -> None:
     blocks = events_df.event.create_blocks(groupby='sentence')
     out = blocks.event.merge_blocks(min_block_duration_s=3)
@@ -157,6 +199,7 @@ def test_split_wav_as_blocks(events_df) -> None:
     assert len(sounds) == 4
     assert (sounds.start == [0.0, 1.5, 2.5, 3.5]).all()
     assert (sounds.duration == [1.5, 1.0, 1.0, 1.5]).all()
+    assert (sounds.offset == [0.0, 1.5, 2.5, 3.5]).all()
     assert (sounds.filepath.values == events_df[events_df.kind == 'sound'].filepath.values).all()
 
 
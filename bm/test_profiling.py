@@ -0,0 +1,40 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+
+import multiprocessing
+from pathlib import Path
+
+from bm import profiling
+from bm.features import FeaturesBuilder
+from bm.studies.fake import make_fake_events
+from bm.utils import Frequency
+
+
+def _build(builder: FeaturesBuilder) -> None:
+    builder(1., 3.)
+
+
+def test_profiling(tmp_path: Path) -> None:
+    profiling.enable(tmp_path)
+    try:
+        events = make_fake_events(total_duration=5)
+        builder = FeaturesBuilder(events, ["WordLength", "WordPulse"], {},
+                                  sample_rate=Frequency(10))
+        builder(0., 2.)
+        # statistics of forked processes (e.g. DataLoader workers) are aggregated
+        process = multiprocessing.get_context("fork").Process(target=_build, args=(builder,))
+        process.start()
+        process.join()
+        assert process.exitcode == 0
+        stats = profiling.get_stats()
+        assert stats[("WordLength", "get_values")][0] == 1
+        assert stats[("WordLength", "render")][0] == 2
+        assert stats[("WordPulse", "post_process")][0] == 2
+        assert stats[("WordPulse", "get_on_overlap")][0] > 0
+        report = profiling.format_report(stats)
+        assert "get_on_overlap" in report
+    finally:
+        profiling.disable()
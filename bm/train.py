@@ -19,6 +19,7 @@ from omegaconf import OmegaConf
 import torch
 
 from . import dataset as dset
+from . import profiling
 from .models import ConvRNN, SimpleConv, DeepMel
 from .solver import Solver
 
@@ -137,6 +138,8 @@ def run(args: tp.Any) -> float:
         logging.getLogger("dora").setLevel(logging.DEBUG)
 
     flashy.distrib.init()
+    if args.profile_features:
+        profiling.enable()
 
     solver = get_solver(args)
 
@@ -45,9 +45,9 @@ def get_wer(
         tmin = solver.args.dset.tmin
     check_at_time = int((-tmin) * solver.args.dset.sample_rate) + 2
     for batch in logprog:
-        word_hash = batch.features[:, test_features.get_slice('WordHash')][:, 0]
+        word_hash = batch.features[:, test_features.get_slice('WordHash', raw=True)][:, 0]
         features = test_features.extract_features(
-            batch.features, solver.used_features.keys())
+            batch.features, solver.used_features.keys(), raw=True)
         with torch.no_grad():
             estimate, output, features_mask, reject_mask = solver._process_batch(
                 batch.replace(features=features))